@@ -0,0 +1,275 @@
+#!/usr/bin/env python3
+
+################################################################################
+#
+#   \file
+#   \author     <a href="http://www.innomatic.ca">innomatic</a>
+#   \brief      asyncio packet transport of SerialCom
+#   \copyright  <a rel="license" href="http://creativecommons.org/licenses/by-nc/4.0/"><img alt="Creative Commons Licence" style="border-width:0" src="https://i.creativecommons.org/l/by-nc/4.0/88x31.png" /></a><br />This work is licensed under a <a rel="license" href="http://creativecommons.org/licenses/by-nc/4.0/">Creative Commons Attribution-NonCommercial 4.0 International License</a>.
+#
+#   Serial port and PacketDecoder driven by an asyncio event loop, without wx
+#   and without a thread per port. On POSIX the port is watched by the event
+#   loop itself (add_reader/add_writer), elsewhere it is polled.
+#
+#   Decoded packets are kept in a bounded buffer. When it is full the port is
+#   not read any more until the consumer catches up, so the data waits in the
+#   driver and the device instead of piling up in memory.
+#
+#   @code
+#   async def Monitor(port):
+#       async with AsyncDevice(port, 115200) as dev:
+#           await dev.Send(OutPackets['TSC Report Set'][2:-1])
+#           async for frame in dev.Frames():
+#               print(frame)
+#
+#   # one event loop for many boards
+#   async def Main(ports):
+#       await asyncio.gather(*[Monitor(port) for port in ports])
+#   @endcode
+#
+
+import asyncio
+import collections
+import serial
+import time
+from SerialCom import *
+
+#--------1---------2---------3---------4---------5---------6---------7---------8
+class AsyncDevice():
+
+    def __init__(self, port, speed=115200, mode='FULL', maxFrames=4096,
+            maxChunk=4096, pollInterval=0.005, ser=None):
+        # serial port (not open yet)
+        if ser is None:
+            ser = serial.Serial()
+            ser.port = port
+            ser.baudrate = int(speed)
+        self.ser = ser
+        # packet decoder
+        self.pd = PacketDecoder(mode, resync=True)
+        # decoded packets waiting for the consumer and their receive times
+        # (time.monotonic_ns() of the read)
+        self.frames = collections.deque()
+        self.stamps = collections.deque()
+        # receive time of the packet last returned by GetFrame()
+        self.stamp = 0
+        self.maxFrames = maxFrames
+        # maximum size of a single read
+        self.maxChunk = maxChunk
+        # number of bytes received
+        self.rxBytes = 0
+        # polling interval where the port can not be watched by the loop
+        self.pollInterval = pollInterval
+        # state
+        self.loop = None
+        self.watched = False
+        self.paused = False
+        self.closed = True
+        self.pollTask = None
+        # set when new packets arrive or the device is closed
+        self.event = asyncio.Event()
+        # set when the port becomes writable
+        self.writable = None
+
+    async def __aenter__(self):
+        await self.Open()
+        return self
+
+    async def __aexit__(self, *args):
+        self.Close()
+
+    ## open the port and start reading
+    async def Open(self):
+        self.loop = asyncio.get_running_loop()
+
+        # non-blocking read and write
+        self.ser.timeout = 0
+        self.ser.write_timeout = 0
+        self.ser.open()
+        self.closed = False
+
+        # let the event loop watch the port if possible
+        try:
+            self.loop.add_reader(self.ser.fileno(), self._OnReadable)
+            self.watched = True
+        except (AttributeError, NotImplementedError, OSError, ValueError):
+            self.watched = False
+            self.pollTask = self.loop.create_task(self._Poll())
+
+    ## stop reading and close the port
+    def Close(self):
+        if self.closed:
+            return
+
+        self.closed = True
+        if self.watched:
+            self._PauseReading()
+        if self.pollTask is not None:
+            self.pollTask.cancel()
+            self.pollTask = None
+        self.ser.close()
+
+        # wake up the consumer and the writer
+        self.event.set()
+        if self.writable is not None and not self.writable.done():
+            self.writable.set_result(None)
+
+    ## return True if the port is open
+    def IsOpen(self):
+        return not self.closed
+
+    ## read what is available and decode it
+    def _ReadAvailable(self):
+        try:
+            data = self.ser.read(min(self.ser.in_waiting or 1, self.maxChunk))
+        except serial.SerialException:
+            # port is gone
+            self.Close()
+            return 0
+
+        if data:
+            stamp = time.monotonic_ns()
+            self.rxBytes += len(data)
+            frames = self.pd.Feed(data)
+            self.frames.extend(frames)
+            self.stamps.extend([stamp] * len(frames))
+            self.event.set()
+
+            # buffer is full: stop reading
+            if len(self.frames) >= self.maxFrames:
+                self._PauseReading()
+
+        return len(data)
+
+    ## event loop callback
+    def _OnReadable(self):
+        self._ReadAvailable()
+
+    ## polling loop where the port can not be watched
+    async def _Poll(self):
+        while not self.closed:
+            if self.paused or not self._ReadAvailable():
+                await asyncio.sleep(self.pollInterval)
+
+    def _PauseReading(self):
+        if not self.paused:
+            self.paused = True
+            if self.watched:
+                self.loop.remove_reader(self.ser.fileno())
+
+    def _ResumeReading(self):
+        if self.paused and not self.closed:
+            self.paused = False
+            if self.watched:
+                self.loop.add_reader(self.ser.fileno(), self._OnReadable)
+
+    ## return all the decoded packets available now (may be empty)
+    def GetFrames(self):
+        return self.GetStampedFrames()[0]
+
+    ## return all the decoded packets available now and their receive times
+    def GetStampedFrames(self):
+        frames = list(self.frames)
+        stamps = list(self.stamps)
+        self.frames.clear()
+        self.stamps.clear()
+        self._ResumeReading()
+        return frames, stamps
+
+    ## wait for the next packet; returns None when the device is closed
+    async def GetFrame(self):
+        while not self.frames:
+            if self.closed:
+                return None
+            self.event.clear()
+            await self.event.wait()
+
+        frame = self.frames.popleft()
+        self.stamp = self.stamps.popleft()
+
+        # resume reading when half of the buffer is free
+        if self.paused and len(self.frames) <= self.maxFrames // 2:
+            self._ResumeReading()
+
+        return frame
+
+    ## asynchronous iterator of the decoded packets until the device is
+    # closed
+    async def Frames(self):
+        while True:
+            frame = await self.GetFrame()
+            if frame is None:
+                return
+            yield frame
+
+    ## send raw bytes; returns when all of them are handed to the driver
+    async def Write(self, data):
+        data = memoryview(bytes(data))
+
+        while len(data) and not self.closed:
+            try:
+                count = self.ser.write(data) or 0
+            except serial.SerialTimeoutException:
+                count = 0
+            data = data[count:]
+
+            # wait until the port can take more
+            if len(data):
+                await self._Writable()
+
+    ## wait until the port is writable
+    async def _Writable(self):
+        try:
+            fd = self.ser.fileno()
+        except (AttributeError, NotImplementedError):
+            await asyncio.sleep(self.pollInterval)
+            return
+
+        self.writable = self.loop.create_future()
+        self.loop.add_writer(fd, self._OnWritable)
+        try:
+            await self.writable
+        finally:
+            self.loop.remove_writer(fd)
+
+    def _OnWritable(self):
+        if not self.writable.done():
+            self.writable.set_result(None)
+
+    ## send a packet with the given payload
+    async def Send(self, payload):
+        await self.Write(MakePacket(payload))
+
+    ## wait until the bytes written are sent out by the driver
+    async def Drain(self, timeout=1.0):
+        if self.closed:
+            return
+        try:
+            await asyncio.wait_for(
+                    self.loop.run_in_executor(None, self.ser.flush), timeout)
+        except (asyncio.TimeoutError, serial.SerialException, OSError):
+            pass
+
+
+#--------1---------2---------3---------4---------5---------6---------7---------8
+if __name__=='__main__':
+    import sys
+    import time
+
+    # print the packets from all the given ports
+    async def Monitor(port, speed):
+        async with AsyncDevice(port, speed, 'DECODE') as dev:
+            await dev.Send(OutPackets['TSC Report Set'][2:-1])
+            async for frame in dev.Frames():
+                print('{:.3f} {}: {}'.format(time.monotonic(), port, frame))
+
+    async def Main(ports):
+        await asyncio.gather(*[Monitor(port, 115200) for port in ports])
+
+    if len(sys.argv) < 2:
+        print('usage: AsyncCom.py port [port ...]')
+    else:
+        try:
+            asyncio.run(Main(sys.argv[1:]))
+        except KeyboardInterrupt:
+            pass
@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+
+################################################################################
+#
+#   \file
+#   \author     <a href="http://www.innomatic.ca">innomatic</a>
+#   \brief      FIFO queue holds bytes as its data
+#   \copyright  <a rel="license" href="http://creativecommons.org/licenses/by-nc/4.0/"><img alt="Creative Commons Licence" style="border-width:0" src="https://i.creativecommons.org/l/by-nc/4.0/88x31.png" /></a><br />This work is licensed under a <a rel="license" href="http://creativecommons.org/licenses/by-nc/4.0/">Creative Commons Attribution-NonCommercial 4.0 International License</a>.
+#
+#   Python counterpart of ByteQueue.c. The queue is a fixed size ring buffer
+#   protected by a lock, so that one thread can put chunks of data while
+#   the other takes out everything at once.
+#
+#   When the queue is full, the overflow policy decides what happens:
+#
+#   * 'DROP' throws away the oldest bytes to make room
+#   * 'BLOCK' waits until the reader makes room (or the timeout expires,
+#     in which case the rest of the data is thrown away)
+#
+#   Either way the number of bytes thrown away is counted in dropped.
+#
+#   The reader can wait for the data with Wait() instead of polling.
+#
+
+import threading
+import time
+
+#--------1---------2---------3---------4---------5---------6---------7---------8
+class ByteQueue():
+
+    def __init__(self, size=1<<20, policy='DROP'):
+        # storage
+        self.buffer = bytearray(size)
+        self.size = size
+        # read position and number of bytes in the queue
+        self.head = 0
+        self.count = 0
+        # number of bytes thrown away
+        self.dropped = 0
+        # overflow policy
+        self.policy = 'DROP'
+        self.SetPolicy(policy)
+        # lock and the condition for the blocking put
+        self.cond = threading.Condition()
+
+    ## Set overflow policy: 'DROP' (the oldest) or 'BLOCK'
+    def SetPolicy(self, policy):
+        if policy.upper() in ('DROP', 'BLOCK'):
+            self.policy = policy.upper()
+
+    ## Copy data into the storage at the tail. Call with the lock held.
+    def _Write(self, data):
+        tail = (self.head + self.count) % self.size
+        first = min(len(data), self.size - tail)
+        self.buffer[tail:tail + first] = data[:first]
+        self.buffer[:len(data) - first] = data[first:]
+        self.count += len(data)
+
+    ## Enqueue a chunk of data. Timeout (in seconds) applies to 'BLOCK' policy
+    # only. Returns the number of bytes enqueued.
+    def Put(self, data, timeout=None):
+        data = memoryview(data).cast('B')
+
+        with self.cond:
+            if self.policy == 'DROP':
+                # data larger than the queue: keep the last part only
+                if len(data) > self.size:
+                    self.dropped += len(data) - self.size
+                    data = data[-self.size:]
+                # make room by dropping the oldest
+                over = self.count + len(data) - self.size
+                if over > 0:
+                    self.head = (self.head + over) % self.size
+                    self.count -= over
+                    self.dropped += over
+                self._Write(data)
+                # wake up the waiting reader
+                self.cond.notify_all()
+                return len(data)
+
+            # blocking put: write as much as room allows
+            deadline = None if timeout is None else time.monotonic() + timeout
+            written = 0
+            while written < len(data):
+                room = self.size - self.count
+                if room == 0:
+                    left = None if deadline is None else \
+                            deadline - time.monotonic()
+                    # timeout: drop the rest
+                    if left is not None and left <= 0:
+                        self.dropped += len(data) - written
+                        break
+                    self.cond.wait(left)
+                    continue
+                part = data[written:written + room]
+                self._Write(part)
+                written += len(part)
+                self.cond.notify_all()
+            return written
+
+    ## Dequeue all the data as a bytes object (empty if there is none)
+    def Get(self):
+        with self.cond:
+            if self.count == 0:
+                return b''
+            end = self.head + self.count
+            if end <= self.size:
+                data = bytes(self.buffer[self.head:end])
+            else:
+                data = bytes(self.buffer[self.head:]) + \
+                        bytes(self.buffer[:end - self.size])
+            self.head = 0
+            self.count = 0
+            # wake up the blocked writer
+            self.cond.notify_all()
+            return data
+
+    ## Wait until there is at least the given number of bytes in the queue,
+    # the function 'until' (if given) returns True, or the timeout (in
+    # seconds) expires. Returns the number of bytes. Notify the condition
+    # (self.cond) when the result of 'until' changes.
+    def Wait(self, count=1, timeout=None, until=None):
+        with self.cond:
+            if until is None:
+                self.cond.wait_for(lambda: self.count >= count, timeout)
+            else:
+                self.cond.wait_for(lambda: self.count >= count or until(),
+                        timeout)
+            return self.count
+
+    ## Wait until there is room for the given number of bytes (at most the
+    # size of the queue) or the timeout (in seconds) expires. Returns the
+    # room.
+    def WaitRoom(self, count, timeout=None):
+        count = min(count, self.size)
+        with self.cond:
+            self.cond.wait_for(lambda: self.size - self.count >= count,
+                    timeout)
+            return self.size - self.count
+
+    ## Return the number of bytes in the queue
+    def Count(self):
+        return self.count
+
+    ## Throw away the data in the queue (not counted as dropped)
+    def Clear(self):
+        with self.cond:
+            self.head = 0
+            self.count = 0
+            self.cond.notify_all()
+
+
+#--------1---------2---------3---------4---------5---------6---------7---------8
+if __name__=='__main__':
+    print('Unit Test for ByteQueue()')
+
+    # drop oldest
+    bq = ByteQueue(8)
+    bq.Put(b'0123')
+    bq.Put(b'456789')
+    print('drop:', bq.Get(), 'dropped', bq.dropped)
+
+    # wrap around
+    bq.Put(b'abcdef')
+    bq.Put(b'ghij')
+    print('wrap:', bq.Get(), 'dropped', bq.dropped)
+
+    # blocking put with a reader on another thread
+    bq = ByteQueue(8, 'BLOCK')
+    received = bytearray()
+    def Reader():
+        while len(received) < 100:
+            received.extend(bq.Get())
+            time.sleep(0.001)
+    thread = threading.Thread(target=Reader)
+    thread.start()
+    bq.Put(bytes(range(100)))
+    thread.join()
+    print('block:', bytes(received) == bytes(range(100)), 'dropped',
+            bq.dropped)
+
+    # waiting for the room
+    bq.Put(b'01234567')
+    threading.Timer(0.01, bq.Get).start()
+    print('room:', bq.WaitRoom(4, 0), bq.WaitRoom(4, 1))
+
+    # blocking put with timeout
+    bq.Put(b'0123456789', timeout=0.01)
+    print('timeout:', bq.Get(), 'dropped', bq.dropped)
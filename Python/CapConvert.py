@@ -0,0 +1,300 @@
+#!/usr/bin/env python3
+
+################################################################################
+#
+#   \file
+#   \author     <a href="http://www.innomatic.ca">innomatic</a>
+#   \brief      Offline converter of the captured data into NumPy or CSV
+#   \copyright  <a rel="license" href="http://creativecommons.org/licenses/by-nc/4.0/"><img alt="Creative Commons Licence" style="border-width:0" src="https://i.creativecommons.org/l/by-nc/4.0/88x31.png" /></a><br />This work is licensed under a <a rel="license" href="http://creativecommons.org/licenses/by-nc/4.0/">Creative Commons Attribution-NonCommercial 4.0 International License</a>.
+#
+#   The capture file (raw bytes, possibly compressed, or the indexed format
+#   of Capture.py) is read and decoded in large chunks, and the TSC reports
+#   are written out as they are decoded, so the file size is limited by the
+#   disk only.
+#
+#   * npy: (n_samples, n_channels) array of the values
+#   * npz: 'values' as above, and 'times' (receive time in ns) of the
+#     samples if the capture has them
+#   * csv: one line per sample, with the receive time first if available
+#
+#   The columns are fixed by the first report; reports of another type or
+#   width are skipped and counted.
+#
+#   \verbatim
+#   python3 CapConvert.py wxpyterm-20240105-143000.dat
+#   python3 CapConvert.py soak-0003.dat.gz --format csv -o soak.csv
+#   \endverbatim
+#
+
+import argparse
+import os
+import shutil
+import struct
+import sys
+import tempfile
+import time
+import zipfile
+from Capture import *
+
+#--------1---------2---------3---------4---------5---------6---------7---------8
+##
+# \brief    Streaming writer of an .npy file
+# \details  The array grows along the first axis. The header is written
+#           with a fixed size and rewritten with the final shape on close.
+#
+class NpyWriter:
+
+    # size of the header including the magic string
+    headerSize = 128
+
+    def __init__(self, path, dtype, columns):
+        self.file = open(path, 'wb')
+        self.dtype = np.dtype(dtype)
+        self.columns = columns
+        self.rows = 0
+        self._WriteHeader()
+
+    def _WriteHeader(self):
+        shape = (self.rows, self.columns) if self.columns else (self.rows,)
+        header = "{{'descr': '{}', 'fortran_order': False, 'shape': {}, }}"\
+                .format(self.dtype.str, shape)
+        # version 1.0: magic, version, header length, padded header
+        size = self.headerSize - 10
+        header = header.ljust(size - 1) + '\n'
+        self.file.seek(0)
+        self.file.write(b'\x93NUMPY\x01\x00' + struct.pack('<H', size) +
+                header.encode('latin-1'))
+        self.file.seek(0, os.SEEK_END)
+
+    def Write(self, data):
+        self.file.write(np.ascontiguousarray(data, self.dtype).tobytes())
+        self.rows += len(data)
+
+    def Close(self):
+        self._WriteHeader()
+        self.file.close()
+
+##
+# \brief    Streaming writer of an .npz file with 'values' and 'times'
+#
+class NpzWriter:
+
+    def __init__(self, path, dtype, columns, times):
+        self.path = path
+        self.tmp = tempfile.mkdtemp(dir=os.path.dirname(path) or '.')
+        self.values = NpyWriter(os.path.join(self.tmp, 'values.npy'), dtype,
+                columns)
+        self.times = NpyWriter(os.path.join(self.tmp, 'times.npy'),
+                'i8', 0) if times else None
+
+    def Write(self, data, times=None):
+        self.values.Write(data)
+        if self.times is not None:
+            self.times.Write(times)
+
+    def Close(self):
+        writers = [self.values] + ([self.times] if self.times else [])
+        with zipfile.ZipFile(self.path, 'w', allowZip64=True) as z:
+            for writer in writers:
+                writer.Close()
+                z.write(writer.file.name, os.path.basename(writer.file.name))
+        shutil.rmtree(self.tmp)
+
+##
+# \brief    Streaming writer of a CSV file
+#
+class CsvWriter:
+
+    def __init__(self, path, columns, times):
+        self.file = open(path, 'w')
+        names = ['ch{:d}'.format(idx) for idx in range(columns)]
+        if times:
+            names.insert(0, 'time_ns')
+        self.file.write(','.join(names) + '\n')
+
+    def Write(self, data, times=None):
+        if times is not None:
+            data = np.column_stack((times, data))
+        np.savetxt(self.file, data, fmt='%d', delimiter=',')
+
+    def Close(self):
+        self.file.close()
+
+#--------1---------2---------3---------4---------5---------6---------7---------8
+## Return True if the file is in the indexed capture format
+def IsIndexed(path):
+    with open(path, 'rb') as f:
+        magic = f.read(len(CAP_MAGIC))
+    return magic in [code for code, packer, unpacker in
+            BlockCompressions.values()]
+
+## Generate (receive time or None, data) of the chunks of a capture file
+def ReadChunks(path, chunkSize=1<<22):
+    if IsIndexed(path):
+        with CaptureReader(path) as rd:
+            yield from rd.Chunks()
+        return
+
+    # raw bytes, compressed or not
+    opener = open
+    for name, (func, ext) in Compressions.items():
+        if ext and path.endswith(ext):
+            opener = func
+    with opener(path, 'rb') as f:
+        while True:
+            data = f.read(chunkSize)
+            if not data:
+                break
+            yield None, data
+
+##
+# \brief    Capture file converter
+#
+class Converter:
+
+    def __init__(self, path, output, fmt, chunkSize=1<<22, batch=1<<16):
+        self.path = path
+        self.output = output
+        self.fmt = fmt
+        self.chunkSize = chunkSize
+        # number of packets decoded at once
+        self.batch = batch
+        self.pd = PacketDecoder('PAYLOAD', resync=True)
+        self.rd = ReportDecoder()
+        self.indexed = IsIndexed(path)
+        # report type and size, fixed by the first report
+        self.code = None
+        self.length = None
+        self.writer = None
+        # statistics
+        self.bytes = 0
+        self.packets = 0
+        self.samples = 0
+        self.mismatched = 0
+        self.others = 0
+
+    ## create the writer for the report of the payload
+    def _Open(self, payload):
+        self.code = payload[0]
+        self.length = len(payload)
+        channels = self.rd.GetChannels(self.code, self.length)
+        dtype = ReportTypes[self.code][1]
+
+        if self.fmt == 'npy':
+            self.writer = NpyWriter(self.output, dtype, channels)
+        elif self.fmt == 'npz':
+            self.writer = NpzWriter(self.output, dtype, channels,
+                    self.indexed)
+        else:
+            self.writer = CsvWriter(self.output, channels, self.indexed)
+
+    ## decode and write a batch of payloads with their receive times
+    def _Write(self, payloads, stamps):
+        self.packets += len(payloads)
+
+        if self.code is None:
+            for payload in payloads:
+                if payload and self.rd.GetChannels(payload[0], len(payload)):
+                    self._Open(payload)
+                    break
+            else:
+                self.others += len(payloads)
+                return
+
+        channels = self.rd.GetChannels(self.code, self.length)
+        data = self.rd.DecodeArray(payloads, self.code, channels)
+        stamps = np.array(stamps, np.int64) if self.indexed else None
+
+        # some are not of the type and the size of the first report
+        if len(data) < len(payloads):
+            keep = [idx for idx, p in enumerate(payloads)
+                    if len(p) == self.length and p[0] == self.code]
+            reports = len([p for p in payloads
+                if p and self.rd.GetChannels(p[0], len(p)) is not None])
+            self.mismatched += reports - len(keep)
+            self.others += len(payloads) - reports
+            if stamps is not None:
+                stamps = stamps[keep]
+
+        self.samples += len(data)
+        if len(data) == 0:
+            return
+        if self.fmt == 'npy':
+            self.writer.Write(data)
+        else:
+            self.writer.Write(data, stamps)
+
+    def Run(self):
+        payloads = []
+        stamps = []
+
+        for stamp, data in ReadChunks(self.path, self.chunkSize):
+            self.bytes += len(data)
+            frames = self.pd.Feed(data)
+            payloads += frames
+            stamps += [stamp] * len(frames)
+
+            if len(payloads) >= self.batch:
+                self._Write(payloads, stamps)
+                payloads = []
+                stamps = []
+
+        if payloads:
+            self._Write(payloads, stamps)
+        if self.writer is not None:
+            self.writer.Close()
+
+    ## return the statistics of the conversion
+    def GetStats(self):
+        stats = {
+                'bytes': self.bytes,
+                'packets': self.packets,
+                'samples': self.samples,
+                'mismatched': self.mismatched,
+                'others': self.others,
+                }
+        stats.update(self.pd.GetStats())
+        return stats
+
+
+#--------1---------2---------3---------4---------5---------6---------7---------8
+if __name__=='__main__':
+
+    parser = argparse.ArgumentParser(
+            description='Convert a capture file into NumPy or CSV')
+    parser.add_argument('input', help='capture file')
+    parser.add_argument('-o', '--output', help='output file name ' +
+            '(default: input file name with the extension of the format)')
+    parser.add_argument('-f', '--format', choices=('npy', 'npz', 'csv'),
+            default='npy', help='output format (default: npy)')
+    parser.add_argument('--chunk', type=float, default=4,
+            help='read size in MB (default: 4)')
+    args = parser.parse_args()
+
+    if np is None:
+        print('numpy is required')
+        sys.exit(1)
+
+    output = args.output
+    if output is None:
+        root = args.input
+        for name, (func, ext) in Compressions.items():
+            if ext and root.endswith(ext):
+                root = root[:-len(ext)]
+        output = os.path.splitext(root)[0] + '.' + args.format
+
+    start = time.perf_counter()
+    conv = Converter(args.input, output, args.format, int(args.chunk * 1e6))
+    conv.Run()
+    elapsed = time.perf_counter() - start
+
+    stats = conv.GetStats()
+    if conv.writer is None:
+        print('no reports in', args.input)
+    else:
+        print('{} samples written to {}'.format(stats['samples'], output))
+    print('{:.1f} MB in {:.2f} s ({:.1f} MB/s)'.format(stats['bytes'] / 1e6,
+        elapsed, stats['bytes'] / 1e6 / max(elapsed, 1e-9)))
+    for key in ('packets', 'samples', 'mismatched', 'others', 'csumErrors',
+            'sizeErrors', 'skipped', 'recovered'):
+        print('  {:12s}{:d}'.format(key, stats[key]))
@@ -0,0 +1,670 @@
+#!/usr/bin/env python3
+
+################################################################################
+#
+#   \file
+#   \author     <a href="http://www.innomatic.ca">innomatic</a>
+#   \brief      Disk-backed capture of the received data
+#   \copyright  <a rel="license" href="http://creativecommons.org/licenses/by-nc/4.0/"><img alt="Creative Commons Licence" style="border-width:0" src="https://i.creativecommons.org/l/by-nc/4.0/88x31.png" /></a><br />This work is licensed under a <a rel="license" href="http://creativecommons.org/licenses/by-nc/4.0/">Creative Commons Attribution-NonCommercial 4.0 International License</a>.
+#
+#   CaptureWriter streams the received data to disk from a background
+#   thread, in large blocks, so memory use stays flat however long the
+#   session is. The data goes to a working file (path + '.part'), which is
+#   turned into a segment file by renaming:
+#
+#   * Save() closes the working file and renames it to the given name; the
+#     data that follows goes to a new working file
+#   * with rotation by size (maxBytes) or by age (maxSeconds), the working
+#     file is closed and renamed to root-NNNN.ext once it reaches the limit
+#
+#   Segments can be compressed with 'gzip', 'bz2' or 'lzma'; the extension
+#   of the compression is then added to the file names.
+#
+#   @code
+#   cap = CaptureWriter('soak.dat', maxBytes=100<<20, compress='gzip')
+#   cap.Start()
+#   cap.Write(data)         # never blocks
+#   cap.Save('snap.dat')    # snap.dat.gz
+#   cap.Stop()              # soak-0000.dat.gz, soak-0001.dat.gz, ...
+#   @endcode
+#
+#   IndexedCaptureWriter writes the same data in the indexed format, in
+#   which every chunk carries its receive time (time.monotonic_ns()) and a
+#   sparse index of the chunks starting at a packet boundary is appended
+#   when the file is closed. CaptureReader maps such a file into memory,
+#   finds a moment in it by binary search of the index, and replays the
+#   chunks from there through PacketDecoder.
+#
+#   \verbatim
+#   header   '<8sqq'  magic, wall clock and monotonic time (ns) at creation
+#   chunk    '<QI'    receive time (ns), size; followed by the data
+#   ...
+#   index    '<QQQ'   receive time, file offset and stream offset of a chunk
+#   ...
+#   footer   '<QQQ8s' file offset and number of the index entries, time of
+#                     the last chunk, end marker
+#   \endverbatim
+#
+#   A file without the footer (a .part file after a crash) is still read:
+#   the index is rebuilt from the chunk headers.
+#
+#   The indexed file can be compressed ('gzip', 'bz2' or 'lzma') block by
+#   block, one block per write to the disk, so it can still be read from any
+#   point. The magic tells the compression, and the chunks are then kept in
+#   blocks which decompress to the chunks above:
+#
+#   \verbatim
+#   block    '<QQI'   receive time and stream offset of the first chunk,
+#                     compressed size; followed by the compressed chunks
+#   \endverbatim
+#
+#   The index entries then point at the block holding the chunk, whose
+#   stream offset tells where the chunk is in the block.
+#
+
+import bisect
+import bz2
+import gzip
+import lzma
+import mmap
+import os
+import shutil
+import struct
+import threading
+import time
+from ByteQueue import ByteQueue
+from SerialCom import *
+
+# compression: (file opener, file name extension)
+Compressions = {
+        None: (open, ''),
+        'gzip': (gzip.open, '.gz'),
+        'bz2': (bz2.open, '.bz2'),
+        'lzma': (lzma.open, '.xz'),
+        }
+
+#--------1---------2---------3---------4---------5---------6---------7---------8
+class CaptureWriter:
+
+    def __init__(self, path, maxBytes=0, maxSeconds=0, compress=None,
+            queueSize=1<<24, blockSize=1<<20, flushInterval=1.0):
+        if compress not in Compressions:
+            raise ValueError('unknown compression: ' + str(compress))
+        # file names
+        self.path = path
+        self.opener, self.ext = Compressions[compress]
+        self.part = path + '.part'
+        # rotation limits (0: no rotation)
+        self.maxBytes = maxBytes
+        self.maxSeconds = maxSeconds
+        # data waiting for the disk
+        self.queue = ByteQueue(queueSize, 'BLOCK')
+        self.blockSize = blockSize
+        self.flushInterval = flushInterval
+        # working file, its size and creation time
+        self.file = None
+        self.size = 0
+        self.opened = 0.0
+        # serial number of the rotated segments
+        self.segment = 0
+        # requests to the thread: list of (function, args, done event, result)
+        self.requests = []
+        self.lock = threading.Lock()
+        # worker thread
+        self.worker = None
+        self.keepGoing = False
+        # statistics
+        self.written = 0
+        self.dropped = 0
+        self.error = None
+
+    def Start(self):
+        self.keepGoing = True
+        self.worker = threading.Thread(target=self.Run, name='CaptureWriter',
+                daemon=True)
+        self.worker.start()
+
+    ## write out the queued data and stop. The working file is kept as a
+    # segment if keep is True, or if rotation is in use; removed otherwise.
+    def Stop(self, keep=False):
+        if self.worker is None:
+            return
+        keep = keep or self.maxBytes or self.maxSeconds
+        self._Request(self._Finish, keep)
+        with self.queue.cond:
+            self.keepGoing = False
+            self.queue.cond.notify_all()
+        self.worker.join()
+        self.worker = None
+        # data arrived in the meantime
+        if self.file is not None or self.queue.Count():
+            self._Finish(keep)
+
+    ## queue the data; never blocks. Returns the number of bytes queued.
+    # The receive time (monotonic ns) is not used in this format.
+    def Write(self, data, stamp=None):
+        count = self.queue.Put(data, 0)
+        self.dropped += len(data) - count
+        return count
+
+    ## close the working file and rename it to path (the extension of the
+    # compression is added). Returns the name of the file.
+    def Save(self, path):
+        return self._Request(self._Close, path + self.ext)
+
+    ## throw away the data captured since the last save or rotation
+    def Reset(self):
+        return self._Request(self._Discard)
+
+    ## return the statistics
+    def GetStats(self):
+        return {
+                'written': self.written,
+                'pending': self.queue.Count(),
+                'dropped': self.dropped + self.queue.dropped,
+                'segments': self.segment,
+                'error': self.error,
+                }
+
+    ## run the function on the thread and wait for its result
+    def _Request(self, func, *args):
+        if self.worker is None or not self.worker.is_alive():
+            return func(*args)
+
+        request = [func, args, threading.Event(), None]
+        with self.lock:
+            self.requests.append(request)
+        # wake up the thread
+        with self.queue.cond:
+            self.queue.cond.notify_all()
+        request[2].wait()
+        return request[3]
+
+    ## True if the thread has something else to do than waiting for data
+    def _Pending(self):
+        return bool(self.requests) or not self.keepGoing
+
+    ## write the queued data to the working file
+    def _Flush(self):
+        data = self.queue.Get()
+        if not data:
+            return
+
+        try:
+            if self.file is None:
+                self._OpenFile()
+            self.file.write(data)
+            self.size += len(data)
+            self.written += len(data)
+        except OSError as e:
+            self.error = str(e)
+            self.dropped += len(data)
+
+    ## open a new working file
+    def _OpenFile(self):
+        self.file = self.opener(self.part, 'wb')
+        self.size = 0
+        self.opened = time.monotonic()
+
+    ## close the working file
+    def _CloseFile(self):
+        try:
+            self.file.close()
+        finally:
+            self.file = None
+
+    ## close the working file and move it to the path
+    def _Close(self, path):
+        self._Flush()
+        if self.file is None:
+            return None
+
+        try:
+            self._CloseFile()
+        except OSError as e:
+            self.error = str(e)
+        # cheap rename on the same file system, copy otherwise
+        try:
+            shutil.move(self.part, path)
+        except OSError as e:
+            self.error = str(e)
+            return None
+        return path
+
+    ## name of the next segment
+    def _SegmentName(self):
+        root, ext = os.path.splitext(self.path)
+        name = '{}-{:04d}{}{}'.format(root, self.segment, ext, self.ext)
+        self.segment += 1
+        return name
+
+    def _Discard(self):
+        self.queue.Clear()
+        if self.file is not None:
+            self._CloseFile()
+            os.remove(self.part)
+
+    def _Finish(self, keep):
+        if keep and (self.file is not None or self.queue.Count()):
+            self._Close(self._SegmentName())
+        else:
+            self._Discard()
+
+    ## thread routine
+    def Run(self):
+        while self.keepGoing:
+            # wait for a block of data or a request, or flush what is there
+            # in time
+            self.queue.Wait(self.blockSize, self.flushInterval, self._Pending)
+            self._Flush()
+
+            # rotation
+            if self.file is not None and ((self.maxBytes and
+                    self.size >= self.maxBytes) or (self.maxSeconds and
+                    time.monotonic() - self.opened >= self.maxSeconds)):
+                self._Close(self._SegmentName())
+
+            # requests from the other threads
+            with self.lock:
+                requests, self.requests = self.requests, []
+            for request in requests:
+                request[3] = request[0](*request[1])
+                request[2].set()
+
+
+# indexed capture format
+CAP_MAGIC = b'TSCCAP01'
+CAP_END = b'TSCINDEX'
+_capHeader = struct.Struct('<8sqq')
+_chunkHeader = struct.Struct('<QI')
+_blockHeader = struct.Struct('<QQI')
+_indexEntry = struct.Struct('<QQQ')
+_capFooter = struct.Struct('<QQQ8s')
+
+# compression of the indexed capture: (magic, compressor, decompressor)
+BlockCompressions = {
+        None: (CAP_MAGIC, None, None),
+        'gzip': (b'TSCCAPGZ', gzip.compress, gzip.decompress),
+        'bz2': (b'TSCCAPBZ', bz2.compress, bz2.decompress),
+        'lzma': (b'TSCCAPXZ', lzma.compress, lzma.decompress),
+        }
+
+#--------1---------2---------3---------4---------5---------6---------7---------8
+class IndexedCaptureWriter(CaptureWriter):
+
+    def __init__(self, path, maxBytes=0, maxSeconds=0, queueSize=1<<24,
+            blockSize=1<<20, flushInterval=1.0, indexInterval=1<<16,
+            compress=None):
+        if compress not in BlockCompressions:
+            raise ValueError('unknown compression: ' + str(compress))
+        # the file itself is not compressed, its blocks are
+        CaptureWriter.__init__(self, path, maxBytes, maxSeconds, None,
+                queueSize, blockSize, flushInterval)
+        self.magic, self.compress = BlockCompressions[compress][:2]
+        # (receive time, size) of the chunks in the queue
+        self.chunks = []
+        self.chunkLock = threading.Lock()
+        # minimum stream bytes between the index entries
+        self.indexInterval = indexInterval
+        # index of the working file
+        self.index = []
+        self.stream = 0
+        self.lastIndexed = None
+        self.lastStamp = 0
+        # tracks the packet boundaries
+        self.pd = PacketDecoder('FULL')
+
+    ## queue a chunk with its receive time (monotonic ns, now if not given);
+    # never blocks. A chunk is either queued as a whole or dropped.
+    def Write(self, data, stamp=None):
+        if stamp is None:
+            stamp = time.monotonic_ns()
+
+        with self.chunkLock:
+            if self.queue.size - self.queue.Count() < len(data):
+                self.dropped += len(data)
+                return 0
+            self.queue.Put(data, 0)
+            self.chunks.append((stamp, len(data)))
+        return len(data)
+
+    def _Flush(self):
+        with self.chunkLock:
+            data = self.queue.Get()
+            chunks, self.chunks = self.chunks, []
+        if not data:
+            return
+
+        try:
+            if self.file is None:
+                self._OpenFile()
+
+            # chunks of a compressed block, and where it starts
+            records = bytearray()
+            first, start = chunks[0][0], self.stream
+
+            data = memoryview(data)
+            pos = 0
+            for stamp, size in chunks:
+                chunk = data[pos:pos + size]
+                pos += size
+
+                # chunk starting at a packet boundary
+                if self.pd.IsIdle() and (self.lastIndexed is None or
+                        self.stream - self.lastIndexed >= self.indexInterval):
+                    self.index.append((stamp, self.size, self.stream))
+                    self.lastIndexed = self.stream
+                self.pd.Feed(chunk)
+
+                if self.compress is None:
+                    self.file.write(_chunkHeader.pack(stamp, size))
+                    self.file.write(chunk)
+                    self.size += _chunkHeader.size + size
+                else:
+                    records += _chunkHeader.pack(stamp, size)
+                    records += chunk
+                self.stream += size
+                self.lastStamp = stamp
+
+            if self.compress is not None:
+                packed = self.compress(records)
+                self.file.write(_blockHeader.pack(first, start, len(packed)))
+                self.file.write(packed)
+                self.size += _blockHeader.size + len(packed)
+
+            self.written += len(data)
+        except OSError as e:
+            self.error = str(e)
+            self.dropped += len(data)
+
+    def _OpenFile(self):
+        CaptureWriter._OpenFile(self)
+        self.file.write(_capHeader.pack(self.magic, time.time_ns(),
+            time.monotonic_ns()))
+        self.size = _capHeader.size
+        self.index = []
+        self.stream = 0
+        self.lastIndexed = None
+
+    ## append the index and the footer, then close
+    def _CloseFile(self):
+        try:
+            offset = self.size
+            for entry in self.index:
+                self.file.write(_indexEntry.pack(*entry))
+            self.file.write(_capFooter.pack(offset, len(self.index),
+                self.lastStamp, CAP_END))
+        finally:
+            CaptureWriter._CloseFile(self)
+
+    def _Discard(self):
+        with self.chunkLock:
+            self.chunks = []
+            CaptureWriter._Discard(self)
+        self.pd = PacketDecoder('FULL')
+
+#--------1---------2---------3---------4---------5---------6---------7---------8
+class CaptureReader:
+
+    def __init__(self, path):
+        self.file = open(path, 'rb')
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, self.wall0, self.mono0 = _capHeader.unpack_from(self.map)
+        for compress, (code, packer, unpacker) in BlockCompressions.items():
+            if magic == code:
+                break
+        else:
+            self.Close()
+            raise ValueError(path + ' is not a capture file')
+        # compression of the blocks (None: chunks without blocks)
+        self.compress = compress
+        self.decompress = unpacker
+
+        # index: receive times, file offsets, stream offsets
+        self.times = []
+        self.offsets = []
+        self.streams = []
+        self.lastStamp = 0
+        # end of the chunks
+        self.end = len(self.map)
+
+        if not self._ReadIndex():
+            self._ScanIndex()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.Close()
+
+    def Close(self):
+        self.map.close()
+        self.file.close()
+
+    ## read the index at the end of the file; returns False if there is none
+    def _ReadIndex(self):
+        if len(self.map) < _capHeader.size + _capFooter.size:
+            return False
+        offset, count, last, end = _capFooter.unpack_from(self.map,
+                len(self.map) - _capFooter.size)
+        if end != CAP_END or offset + count * _indexEntry.size + \
+                _capFooter.size != len(self.map):
+            return False
+
+        entries = self.map[offset:offset + count * _indexEntry.size]
+        for stamp, pos, stream in _indexEntry.iter_unpack(entries):
+            self.times.append(stamp)
+            self.offsets.append(pos)
+            self.streams.append(stream)
+        self.lastStamp = last
+        self.end = offset
+        return True
+
+    ## rebuild the index from the chunk headers (every chunk is indexed), or
+    # from the block headers (every block)
+    def _ScanIndex(self):
+        if self.decompress is not None:
+            return self._ScanBlocks()
+
+        pos = _capHeader.size
+        stream = 0
+        while pos + _chunkHeader.size <= len(self.map):
+            stamp, size = _chunkHeader.unpack_from(self.map, pos)
+            # cut short
+            if pos + _chunkHeader.size + size > len(self.map):
+                break
+            self.times.append(stamp)
+            self.offsets.append(pos)
+            self.streams.append(stream)
+            self.lastStamp = stamp
+            pos += _chunkHeader.size + size
+            stream += size
+        self.end = pos
+
+    def _ScanBlocks(self):
+        pos = _capHeader.size
+        last = None
+        while pos + _blockHeader.size <= len(self.map):
+            stamp, stream, size = _blockHeader.unpack_from(self.map, pos)
+            # cut short
+            if pos + _blockHeader.size + size > len(self.map):
+                break
+            self.times.append(stamp)
+            self.offsets.append(pos)
+            self.streams.append(stream)
+            last = pos
+            pos += _blockHeader.size + size
+        self.end = pos
+
+        # time of the last chunk of the last block
+        if last is not None:
+            self.lastStamp = self.times[-1]
+            for stamp, data in self._BlockChunks(last):
+                self.lastStamp = stamp
+
+    ## return the receive times (ns) of the first and the last chunk
+    def GetTimeRange(self):
+        if not self.times:
+            return None
+        return self.times[0], self.lastStamp
+
+    ## convert a receive time to the wall clock time (ns since the epoch)
+    def ToWallTime(self, stamp):
+        return self.wall0 + stamp - self.mono0
+
+    ## return the file offset of the last indexed chunk (or of its block)
+    # received at or before the time (O(log n))
+    def Seek(self, stamp=None):
+        return self._SeekEntry(stamp)[0]
+
+    ## return the file and the stream offset of the index entry
+    def _SeekEntry(self, stamp=None):
+        if stamp is None or not self.offsets:
+            return _capHeader.size, 0
+        idx = max(bisect.bisect_right(self.times, stamp) - 1, 0)
+        return self.offsets[idx], self.streams[idx]
+
+    ## generate (receive time, data) of the chunks of the block at pos
+    def _BlockChunks(self, pos):
+        stamp, stream, size = _blockHeader.unpack_from(self.map, pos)
+        pos += _blockHeader.size
+        records = self.decompress(self.map[pos:pos + size])
+        pos = 0
+        while pos + _chunkHeader.size <= len(records):
+            stamp, size = _chunkHeader.unpack_from(records, pos)
+            pos += _chunkHeader.size
+            yield stamp, records[pos:pos + size]
+            pos += size
+
+    ## generate (receive time, data) of the chunks from the seek point of
+    # the start time to the end time (inclusive). The chunks between the
+    # seek point and the start time are included, for the decoder.
+    def Chunks(self, start=None, end=None):
+        if self.decompress is not None:
+            yield from self._CompressedChunks(start, end)
+            return
+
+        pos = self.Seek(start)
+        while pos + _chunkHeader.size <= self.end:
+            stamp, size = _chunkHeader.unpack_from(self.map, pos)
+            if end is not None and stamp > end:
+                return
+            pos += _chunkHeader.size
+            if pos + size > self.end:
+                return
+            yield stamp, self.map[pos:pos + size]
+            pos += size
+
+    def _CompressedChunks(self, start, end):
+        pos, seek = self._SeekEntry(start)
+        while pos + _blockHeader.size <= self.end:
+            first, stream, size = _blockHeader.unpack_from(self.map, pos)
+            if end is not None and first > end:
+                return
+            if pos + _blockHeader.size + size > self.end:
+                return
+            # from the indexed chunk of the first block
+            for stamp, data in self._BlockChunks(pos):
+                if stream >= seek:
+                    if end is not None and stamp > end:
+                        return
+                    yield stamp, data
+                stream += len(data)
+            pos += _blockHeader.size + size
+
+    ## generate (receive time, packets) of the chunks received in the time
+    # range, decoded by PacketDecoder in the given mode
+    def Replay(self, start=None, end=None, mode='FULL'):
+        pd = PacketDecoder(mode, resync=True)
+        for stamp, data in self.Chunks(start, end):
+            frames = pd.Feed(data)
+            if start is None or stamp >= start:
+                yield stamp, frames
+
+
+#--------1---------2---------3---------4---------5---------6---------7---------8
+if __name__=='__main__':
+    import tempfile
+    print('Unit Test for CaptureWriter()')
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'test.dat')
+        data = bytes(range(256)) * 4096
+
+        # save
+        cap = CaptureWriter(path)
+        cap.Start()
+        cap.Write(data)
+        name = cap.Save(path)
+        with open(name, 'rb') as f:
+            print('save:', f.read() == data, cap.GetStats())
+        cap.Stop()
+
+        # rotation by size with compression
+        cap = CaptureWriter(path, maxBytes=1<<18, compress='gzip',
+                blockSize=1<<16, flushInterval=0.01)
+        cap.Start()
+        for idx in range(0, len(data), 1000):
+            cap.Write(data[idx:idx + 1000])
+            time.sleep(0.00001)
+        cap.Stop()
+        names = sorted(n for n in os.listdir(tmp) if n.startswith('test-'))
+        joined = b''.join(gzip.open(os.path.join(tmp, n)).read()
+                for n in names)
+        print('rotate:', len(names), 'segments', joined == data,
+                cap.GetStats())
+
+        # indexed capture of a report stream, 1 ms apart
+        packets = [MakePacket(struct.pack('>BHH', RPT_U16XXX, idx, idx))
+                for idx in range(20000)]
+        stream = b''.join(packets)
+        cap = IndexedCaptureWriter(path, indexInterval=4096)
+        cap.Start()
+        for idx in range(0, len(stream), 100):
+            cap.Write(stream[idx:idx + 100], idx * 1000000)
+        name = cap.Save(path)
+        cap.Stop()
+
+        with CaptureReader(name) as rd:
+            first, last = rd.GetTimeRange()
+            print('index:', len(rd.times), 'entries', first, last)
+            # replay of a second in the middle
+            start, end = 50000 * 1000000, 51000 * 1000000
+            frames = [f for t, fs in rd.Replay(start, end, 'PAYLOAD')
+                    for f in fs]
+            print('replay:', len(frames), 'packets from',
+                    struct.unpack('>xH', frames[0][:3])[0])
+
+        # the working file without the index
+        with open(path + '.part', 'wb') as f:
+            f.write(open(name, 'rb').read()[:100000])
+        with CaptureReader(path + '.part') as rd:
+            print('scan:', len(rd.times), 'chunks',
+                    sum(len(fs) for t, fs in rd.Replay()), 'packets')
+
+        # the same compressed by blocks
+        cap = IndexedCaptureWriter(path, indexInterval=4096,
+                blockSize=1<<14, flushInterval=0.01, compress='gzip')
+        cap.Start()
+        for idx in range(0, len(stream), 100):
+            cap.Write(stream[idx:idx + 100], idx * 1000000)
+            if idx % 10000 == 0:
+                time.sleep(0.001)
+        name = cap.Save(path)
+        cap.Stop()
+
+        with CaptureReader(name) as rd:
+            frames = [f for t, fs in rd.Replay(start, end, 'PAYLOAD')
+                    for f in fs]
+            print('gzip: {:.1f}x smaller,'.format(len(stream) /
+                os.path.getsize(name)), len(frames), 'packets from',
+                struct.unpack('>xH', frames[0][:3])[0], 'same',
+                b''.join(d for t, d in rd.Chunks()) == stream,
+                rd.GetTimeRange() == (first, last))
+
+        with open(path + '.part', 'wb') as f:
+            f.write(open(name, 'rb').read()[:os.path.getsize(name) // 2])
+        with CaptureReader(path + '.part') as rd:
+            print('gzip scan:', len(rd.times), 'blocks',
+                    sum(len(fs) for t, fs in rd.Replay()), 'packets')
@@ -0,0 +1,312 @@
+#!/usr/bin/env python3
+
+################################################################################
+#
+#   \file
+#   \author     <a href="http://www.innomatic.ca">innomatic</a>
+#   \brief      Pipelined command channel with ACK/NAK tracking
+#   \copyright  <a rel="license" href="http://creativecommons.org/licenses/by-nc/4.0/"><img alt="Creative Commons Licence" style="border-width:0" src="https://i.creativecommons.org/l/by-nc/4.0/88x31.png" /></a><br />This work is licensed under a <a rel="license" href="http://creativecommons.org/licenses/by-nc/4.0/">Creative Commons Attribution-NonCommercial 4.0 International License</a>.
+#
+#   The receiver answers each packet with a single ACK or NAK byte, in the
+#   order the packets arrive. CommandChannel keeps up to a window of commands
+#   in flight and matches the replies to them in the order of transmission:
+#
+#   * ACK completes the oldest command in flight
+#   * NAK retransmits it (at the end of the line) until the retries run out
+#   * no reply within the timeout retransmits all the commands in flight,
+#     since the order of the replies is lost from that point on
+#
+#   A command may thus be executed more than once after a timeout; keep
+#   the commands idempotent (set rather than toggle) for the scripts. The
+#   reset commands (NoRetryCodes) are never sent again: they fail on the
+#   first NAK or timeout instead.
+#
+#   Use it only with a receiver known to reply. Without replies every
+#   command is sent 1 + retries times and then fails on the timeout.
+#
+#   Each command returns a concurrent.futures.Future, which is resolved with
+#   the number of transmissions or fails with CommandError. A callback can be
+#   given instead of (or as well as) waiting on the future. The replies are
+#   given to OnReply() by the receiving side, such as ComThread.
+#
+#   @code
+#   cc = CommandChannel(ser.write)
+#   thread.SetReplyHandler(cc.OnReply)
+#   cc.Start()
+#   futures = [cc.Send(OutPackets[name]) for name in names]
+#   for future in futures:
+#       future.result()
+#   @endcode
+#
+
+import collections
+import concurrent.futures
+import threading
+import time
+from SerialCom import *
+
+#--------1---------2---------3---------4---------5---------6---------7---------8
+## Commands sent only once, whatever the retries
+NoRetryCodes = {SYS_SRESET, SYS_WRESET}
+
+## Failure of a command: NAK after the last retry, timeout or closed channel
+class CommandError(Exception):
+    pass
+
+## command in flight or waiting
+class Command:
+
+    def __init__(self, packet, future, retries):
+        self.packet = packet
+        self.future = future
+        # number of retransmissions allowed
+        self.retries = retries
+        # number of transmissions
+        self.sent = 0
+        # deadline of the reply
+        self.deadline = 0.0
+
+class CommandChannel:
+
+    def __init__(self, write, window=8, timeout=0.5, retries=3):
+        # function sending bytes to the port
+        self.write = write
+        # number of commands in flight
+        self.window = window
+        # reply timeout (in seconds) and number of retransmissions
+        self.timeout = timeout
+        self.retries = retries
+        # commands waiting for the window, in flight
+        self.waiting = collections.deque()
+        self.inflight = collections.deque()
+        self.cond = threading.Condition()
+        # timeout thread
+        self.worker = None
+        self.keepGoing = False
+        self.ResetStats()
+
+    def ResetStats(self):
+        self.acks = 0
+        self.naks = 0
+        self.timeouts = 0
+        self.retransmits = 0
+        self.failures = 0
+        # replies nobody waits for
+        self.unexpected = 0
+
+    def GetStats(self):
+        return {
+                'acks': self.acks,
+                'naks': self.naks,
+                'timeouts': self.timeouts,
+                'retransmits': self.retransmits,
+                'failures': self.failures,
+                'unexpected': self.unexpected,
+                'inflight': len(self.inflight),
+                'waiting': len(self.waiting),
+                }
+
+    ## start the timeout thread
+    def Start(self):
+        self.keepGoing = True
+        self.worker = threading.Thread(target=self.Run,
+                name='CommandChannel', daemon=True)
+        self.worker.start()
+
+    ## stop the thread and fail all the pending commands
+    def Stop(self):
+        with self.cond:
+            self.keepGoing = False
+            self.cond.notify_all()
+        if self.worker is not None:
+            self.worker.join()
+            self.worker = None
+        self.Cancel()
+
+    ## fail all the pending commands, e.g. when the port is (re)opened
+    def Cancel(self):
+        with self.cond:
+            pending = list(self.inflight) + list(self.waiting)
+            self.inflight.clear()
+            self.waiting.clear()
+        for cmd in pending:
+            self._Finish(cmd, CommandError('cancelled'))
+
+    ## queue a command; packet is a full packet or a payload (bytes or
+    # list), the latter wrapped by MakePacket(). The retries of the channel
+    # are used unless given, and none for the reset commands. Returns a
+    # Future.
+    def Send(self, packet, callback=None, retries=None):
+        packet = bytes(packet)
+        if not packet or packet[0] != PKT_HEADR:
+            packet = MakePacket(packet)
+        if len(packet) > 2 and packet[2] in NoRetryCodes:
+            retries = 0
+        elif retries is None:
+            retries = self.retries
+
+        future = concurrent.futures.Future()
+        if callback is not None:
+            future.add_done_callback(callback)
+
+        with self.cond:
+            self.waiting.append(Command(packet, future, retries))
+            self._Fill()
+        return future
+
+    ## send the waiting commands as far as the window allows. Call with the
+    # lock held.
+    def _Fill(self):
+        burst = []
+        while self.waiting and len(self.inflight) < self.window:
+            cmd = self.waiting.popleft()
+            self._Transmit(cmd)
+            burst.append(cmd.packet)
+
+        # one write for the whole burst
+        if burst:
+            self._Write(b''.join(burst))
+
+    ## put a command in flight. Call with the lock held.
+    def _Transmit(self, cmd):
+        cmd.sent += 1
+        cmd.deadline = time.monotonic() + self.timeout
+        self.inflight.append(cmd)
+        # wake up the timeout thread for the new deadline
+        self.cond.notify_all()
+
+    def _Write(self, data):
+        try:
+            self.write(data)
+        except Exception:
+            # port is closed or gone: the commands will time out
+            pass
+
+    ## resolve the future out of the lock
+    def _Finish(self, cmd, error=None):
+        if cmd.future.done():
+            return
+        if error is None:
+            cmd.future.set_result(cmd.sent)
+        else:
+            cmd.future.set_exception(error)
+
+    ## reply handler: give every ACK/NAK/IAM byte received (thread-safe)
+    def OnReply(self, reply):
+        done = None
+        failed = None
+
+        with self.cond:
+            if reply not in (PKT_ACK, PKT_NAK) or not self.inflight:
+                self.unexpected += 1
+                return
+
+            cmd = self.inflight.popleft()
+            if reply == PKT_ACK:
+                self.acks += 1
+                done = cmd
+            else:
+                self.naks += 1
+                if cmd.sent > cmd.retries:
+                    self.failures += 1
+                    failed = cmd
+                else:
+                    self.retransmits += 1
+                    self._Transmit(cmd)
+                    self._Write(cmd.packet)
+
+            self._Fill()
+
+        if done is not None:
+            self._Finish(done)
+        if failed is not None:
+            self._Finish(failed, CommandError('NAK'))
+
+    ## timeout thread routine
+    def Run(self):
+        with self.cond:
+            while self.keepGoing:
+                if not self.inflight:
+                    self.cond.wait()
+                    continue
+
+                left = self.inflight[0].deadline - time.monotonic()
+                if left > 0:
+                    self.cond.wait(left)
+                    continue
+
+                # the replies are out of sync: send all of them again
+                self.timeouts += 1
+                resend = list(self.inflight)
+                self.inflight.clear()
+                failed = []
+                burst = []
+                for cmd in resend:
+                    if cmd.sent > cmd.retries:
+                        self.failures += 1
+                        failed.append(cmd)
+                    else:
+                        self.retransmits += 1
+                        self._Transmit(cmd)
+                        burst.append(cmd.packet)
+                if burst:
+                    self._Write(b''.join(burst))
+                self._Fill()
+
+                # callbacks without the lock
+                self.cond.release()
+                try:
+                    for cmd in failed:
+                        self._Finish(cmd, CommandError('timeout'))
+                finally:
+                    self.cond.acquire()
+
+
+#--------1---------2---------3---------4---------5---------6---------7---------8
+if __name__=='__main__':
+    import random
+    print('Unit Test for CommandChannel()')
+
+    # receiver on the other end: replies in order, may lose or NAK some
+    class Receiver:
+        def __init__(self, nak=0.0, loss=0.0):
+            self.pd = PacketDecoder('FULL')
+            self.channel = None
+            self.nak = nak
+            self.loss = loss
+            self.received = 0
+            self.rnd = random.Random(0)
+        def Write(self, data):
+            for packet in self.pd.Feed(data):
+                self.received += 1
+                if self.rnd.random() < self.loss:
+                    continue
+                reply = PKT_NAK if self.rnd.random() < self.nak else PKT_ACK
+                threading.Timer(0.001, self.channel.OnReply, (reply,)).start()
+
+    for nak, loss in ((0.0, 0.0), (0.1, 0.0), (0.1, 0.05)):
+        rx = Receiver(nak, loss)
+        cc = CommandChannel(rx.Write, window=8, timeout=0.05, retries=5)
+        rx.channel = cc
+        cc.Start()
+
+        start = time.monotonic()
+        futures = [cc.Send(OutPackets['DIO 01 Set']) for x in range(200)]
+        concurrent.futures.wait(futures, 10)
+        elapsed = time.monotonic() - start
+        cc.Stop()
+
+        ok = len([f for f in futures if f.done() and not f.exception()])
+        print('nak {} loss {}: {} of 200 in {:.2f}s, sent {}, {}'.format(nak,
+            loss, ok, elapsed, rx.received, cc.GetStats()))
+
+    # a reset is sent once even without a reply
+    rx = Receiver(loss=1.0)
+    cc = CommandChannel(rx.Write, timeout=0.05, retries=5)
+    rx.channel = cc
+    cc.Start()
+    future = cc.Send(OutPackets['System Reset'])
+    concurrent.futures.wait([future], 1)
+    cc.Stop()
+    print('reset without reply: sent {}, {}'.format(rx.received,
+        future.exception()))
@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+
+################################################################################
+#
+#   \file
+#   \author     <a href="http://www.innomatic.ca">innomatic</a>
+#   \brief      Min/max decimation of a sample window for plotting
+#   \copyright  <a rel="license" href="http://creativecommons.org/licenses/by-nc/4.0/"><img alt="Creative Commons Licence" style="border-width:0" src="https://i.creativecommons.org/l/by-nc/4.0/88x31.png" /></a><br />This work is licensed under a <a rel="license" href="http://creativecommons.org/licenses/by-nc/4.0/">Creative Commons Attribution-NonCommercial 4.0 International License</a>.
+#
+#   MinMaxDecimator follows a window of the last 'size' samples and reduces
+#   it to about 'width' buckets, one per pixel, each drawn as its minimum
+#   and maximum in the order they occurred. The line drawn from the buckets
+#   looks the same as the line of all the samples, while the number of
+#   points depends on the width of the canvas only.
+#
+#   The buckets are made as the samples arrive, so the cost of a new block
+#   is proportional to its length, not to the window.
+#
+#   @code
+#   dm = MinMaxDecimator(1000000, 2, 800)
+#   dm.Extend(data)                 # (n_samples, n_channels) block
+#   x, ys = dm.Get()                # x (n_points,), ys (2, n_points)
+#   @endcode
+#
+
+import math
+import numpy as np
+from RingBuffer import RingBuffer
+
+#--------1---------2---------3---------4---------5---------6---------7---------8
+class MinMaxDecimator:
+
+    def __init__(self, size, channels=1, width=1000):
+        self.size = max(int(size), 1)
+        self.channels = max(int(channels), 1)
+        self.width = max(int(width), 1)
+        self.Clear()
+
+    ## Forget all the samples. The bucket size is set for the window size
+    # and the width.
+    def Clear(self):
+        self.bucket = max(math.ceil(self.size / self.width), 1)
+        # buckets covering the window, and one more partly out of it
+        buckets = math.ceil(self.size / self.bucket) + 1
+        # first and second (in time) of the minimum and maximum
+        self.first = RingBuffer(buckets, self.channels)
+        self.second = RingBuffer(buckets, self.channels)
+        # samples of the bucket being filled
+        self.partial = np.empty((self.bucket, self.channels))
+        self.fill = 0
+        # number of samples and full buckets so far
+        self.total = 0
+        self.done = 0
+
+    ## Change the window size, the number of channels or the width. The
+    # buckets are made again from the samples (oldest first) if given.
+    def Reset(self, size=None, channels=None, width=None, samples=None):
+        if size is not None:
+            self.size = max(int(size), 1)
+        if channels is not None:
+            self.channels = max(int(channels), 1)
+        if width is not None:
+            self.width = max(int(width), 1)
+        self.Clear()
+        if samples is not None:
+            self.Extend(samples)
+
+    ## return first and second of the buckets (n_buckets, bucket, channels)
+    def _Reduce(self, blocks):
+        imin = blocks.argmin(axis=1)[:, None, :]
+        imax = blocks.argmax(axis=1)[:, None, :]
+        low = np.take_along_axis(blocks, imin, 1)[:, 0, :]
+        high = np.take_along_axis(blocks, imax, 1)[:, 0, :]
+        order = imin[:, 0, :] <= imax[:, 0, :]
+        return np.where(order, low, high), np.where(order, high, low)
+
+    def _Push(self, blocks):
+        first, second = self._Reduce(blocks)
+        self.first.Extend(first)
+        self.second.Extend(second)
+        self.done += len(blocks)
+
+    ## Add a block of samples (n_samples, n_channels)
+    def Extend(self, block):
+        block = np.asarray(block, np.float64)
+        if block.ndim == 1:
+            block = block.reshape(-1, 1)
+        self.total += len(block)
+
+        # complete the bucket being filled
+        if self.fill:
+            count = min(len(block), self.bucket - self.fill)
+            self.partial[self.fill:self.fill + count] = block[:count]
+            self.fill += count
+            block = block[count:]
+            if self.fill < self.bucket:
+                return
+            self._Push(self.partial[None])
+            self.fill = 0
+
+        # full buckets at once, only the ones that can be in the window
+        full = len(block) // self.bucket
+        skip = max(full - len(self.first), 0)
+        if full > skip:
+            self._Push(block[skip * self.bucket:full * self.bucket]
+                    .reshape(-1, self.bucket, self.channels))
+        self.done += skip
+
+        # the rest starts a new bucket
+        rest = len(block) - full * self.bucket
+        self.partial[:rest] = block[full * self.bucket:]
+        self.fill = rest
+
+    ## Return x (sample position in the window) and ys (n_channels,
+    # n_points) of the envelope, two points per bucket
+    def Get(self):
+        start = self.total - self.size
+        # full buckets ending in the window
+        count = min(self.first.Count(),
+                max(math.ceil((self.done * self.bucket - start) /
+                    self.bucket), 0))
+        first = self.first.View(count)
+        second = self.second.View(count)
+        x = (np.arange(self.done - count, self.done) * self.bucket - start)
+
+        # the bucket being filled
+        if self.fill:
+            tail = self._Reduce(self.partial[None, :self.fill])
+            first = np.concatenate((first, tail[0]))
+            second = np.concatenate((second, tail[1]))
+            x = np.append(x, self.done * self.bucket - start)
+
+        points = np.empty((2 * len(x),))
+        points[0::2] = x
+        points[1::2] = x
+        ys = np.empty((self.channels, 2 * len(x)))
+        ys[:, 0::2] = first.T
+        ys[:, 1::2] = second.T
+        # the oldest bucket may start before the window
+        return np.maximum(points, 0), ys
+
+
+#--------1---------2---------3---------4---------5---------6---------7---------8
+if __name__=='__main__':
+    import random
+    import time
+    print('Unit Test for MinMaxDecimator()')
+
+    # against the buckets made from all the samples
+    rnd = random.Random(0)
+    size = 1000
+    dm = MinMaxDecimator(size, 2, 64)
+    data = np.empty((0, 2))
+    for step in range(300):
+        block = np.array([[rnd.gauss(0, 1), rnd.random()]
+            for x in range(rnd.randrange(50))]).reshape(-1, 2)
+        dm.Extend(block)
+        data = np.concatenate((data, block))
+
+    x, ys = dm.Get()
+    total = len(data)
+    ref = []
+    for idx in range((total - size) // dm.bucket,
+            (total - 1) // dm.bucket + 1):
+        bucket = data[idx * dm.bucket:(idx + 1) * dm.bucket]
+        points = []
+        for value in bucket.T:
+            order = sorted((value.argmin(), value.argmax()))
+            points.append(value[order])
+        ref.append(points)
+    # (buckets, channels, 2) to (channels, 2 * buckets)
+    ref = np.array(ref).transpose(1, 0, 2).reshape(2, -1)
+    print('points', len(x), 'bucket', dm.bucket, 'x', x[:4], '...', x[-2:])
+    print('same as the reference:', np.array_equal(ys, ref))
+
+    # a million samples window, updated by blocks
+    dm = MinMaxDecimator(1000000, 8, 1000)
+    block = np.random.default_rng(0).normal(size=(100, 8))
+    start = time.perf_counter()
+    for count in range(10000):
+        dm.Extend(block)
+    elapsed = time.perf_counter() - start
+    start = time.perf_counter()
+    for count in range(100):
+        x, ys = dm.Get()
+    print('extend {:.1f} us/block, get {:.2f} ms, {} points'.format(
+        elapsed / 10000 * 1e6, (time.perf_counter() - start) * 10, len(x)))
@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+
+################################################################################
+#
+#   \file
+#   \author     <a href="http://www.innomatic.ca">innomatic</a>
+#   \brief      Latency histograms of the receive path
+#   \copyright  <a rel="license" href="http://creativecommons.org/licenses/by-nc/4.0/"><img alt="Creative Commons Licence" style="border-width:0" src="https://i.creativecommons.org/l/by-nc/4.0/88x31.png" /></a><br />This work is licensed under a <a rel="license" href="http://creativecommons.org/licenses/by-nc/4.0/">Creative Commons Attribution-NonCommercial 4.0 International License</a>.
+#
+#   Every packet carries the time its chunk was read from the port
+#   (time.monotonic_ns()). Each stage of the receive path adds the time
+#   elapsed since then to the histogram of the stage, e.g.
+#
+#   * 'decode': the packet is decoded on the COM thread
+#   * 'deliver': the packet reaches the GUI thread
+#   * 'draw': the packet is drawn on the graph
+#
+#   The histograms have logarithmic bins (10 per decade from 1 us to 100 s)
+#   so they cost the same however long they run, and they can be added to
+#   from any thread.
+#
+#   @code
+#   lm = LatencyMonitor()
+#   lm.Add('draw', stamps)
+#   print(lm.GetStats()['draw']['p99'])
+#   @endcode
+#
+
+import math
+import threading
+import time
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+#--------1---------2---------3---------4---------5---------6---------7---------8
+class LatencyHistogram:
+
+    # bins per decade, lowest bin edge (ns) and number of decades
+    binsPerDecade = 10
+    lowest = 1000
+    decades = 8
+
+    def __init__(self):
+        self.size = self.binsPerDecade * self.decades
+        self.lock = threading.Lock()
+        self.Reset()
+
+    def Reset(self):
+        with self.lock:
+            # bin 0 holds everything below the lowest edge, the last one
+            # everything above the highest
+            self.counts = [0] * (self.size + 2)
+            self.count = 0
+            self.total = 0
+            self.max = 0
+
+    ## return the bin of a latency (ns)
+    def _Bin(self, value):
+        if value < self.lowest:
+            return 0
+        idx = int(math.log10(value / self.lowest) * self.binsPerDecade) + 1
+        return min(idx, self.size + 1)
+
+    ## return the upper edge (ns) of a bin
+    def _Edge(self, idx):
+        return self.lowest * 10 ** (idx / self.binsPerDecade)
+
+    ## add latencies (ns): a number, or a sequence or an array of them
+    def Add(self, values):
+        if isinstance(values, (int, float)):
+            values = [values]
+        if len(values) == 0:
+            return
+
+        if np is not None:
+            values = np.maximum(np.asarray(values, np.float64), 1.0)
+            idx = np.floor(np.log10(values / self.lowest) *
+                    self.binsPerDecade).astype(np.int64) + 1
+            idx = np.clip(idx, 0, self.size + 1)
+            counts = np.bincount(idx, minlength=self.size + 2).tolist()
+            total = float(values.sum())
+            peak = float(values.max())
+        else:
+            counts = [0] * (self.size + 2)
+            for value in values:
+                counts[self._Bin(value)] += 1
+            total = float(sum(values))
+            peak = max(values)
+
+        with self.lock:
+            self.counts = [a + b for a, b in zip(self.counts, counts)]
+            self.count += len(values)
+            self.total += total
+            self.max = max(self.max, peak)
+
+    ## return the latency (seconds) below which the given percentage of the
+    # packets are, to the resolution of the bins
+    def Percentile(self, percent):
+        with self.lock:
+            counts = list(self.counts)
+            count = self.count
+
+        if count == 0:
+            return 0.0
+        limit = count * percent / 100.0
+        acc = 0
+        for idx, value in enumerate(counts):
+            acc += value
+            if acc >= limit:
+                return min(self._Edge(idx), self.max) / 1e9
+        return self.max / 1e9
+
+    ## return the number of packets and the latencies in seconds
+    def GetStats(self):
+        return {
+                'count': self.count,
+                'mean': self.total / self.count / 1e9 if self.count else 0.0,
+                'p50': self.Percentile(50),
+                'p90': self.Percentile(90),
+                'p99': self.Percentile(99),
+                'max': self.max / 1e9,
+                }
+
+    ## return the list of (upper edge in seconds, count) of the bins
+    def GetBins(self):
+        with self.lock:
+            counts = list(self.counts)
+        return [(self._Edge(idx) / 1e9, value)
+                for idx, value in enumerate(counts)]
+
+##
+# \brief    Latency histograms of the stages
+#
+class LatencyMonitor:
+
+    def __init__(self, stages=('decode', 'deliver', 'draw')):
+        self.stages = list(stages)
+        self.hists = {stage: LatencyHistogram() for stage in self.stages}
+        self.lock = threading.Lock()
+
+    ## add the latencies of the packets read at the stamps (monotonic ns)
+    # to the stage; now is the end of the stage (default: now)
+    def Add(self, stage, stamps, now=None):
+        if now is None:
+            now = time.monotonic_ns()
+        if stage not in self.hists:
+            with self.lock:
+                if stage not in self.hists:
+                    self.stages.append(stage)
+                    self.hists[stage] = LatencyHistogram()
+
+        if np is not None:
+            self.hists[stage].Add(now - np.asarray(stamps, np.int64))
+        else:
+            self.hists[stage].Add([now - stamp for stamp in stamps])
+
+    ## return the histogram of the stage
+    def GetHistogram(self, stage):
+        return self.hists[stage]
+
+    ## return the statistics of all the stages
+    def GetStats(self):
+        return {stage: self.hists[stage].GetStats() for stage in self.stages}
+
+    def Reset(self):
+        for hist in self.hists.values():
+            hist.Reset()
+
+
+#--------1---------2---------3---------4---------5---------6---------7---------8
+if __name__=='__main__':
+    import random
+    print('Unit Test for LatencyHistogram()')
+
+    # exponential latencies with a mean of 1 ms
+    rnd = random.Random(0)
+    values = [rnd.expovariate(1 / 1e6) for x in range(100000)]
+    hist = LatencyHistogram()
+    hist.Add(values)
+    values.sort()
+    print('exact p50 {:.3f} ms, p99 {:.3f} ms'.format(values[50000] / 1e6,
+        values[99000] / 1e6))
+    print('hist  p50 {p50:.5f} s, p99 {p99:.5f} s, mean {mean:.5f} s'.format(
+        **hist.GetStats()))
+
+    lm = LatencyMonitor()
+    now = time.monotonic_ns()
+    lm.Add('draw', [now - 2000000, now - 5000000], now)
+    print(lm.GetStats()['draw'])
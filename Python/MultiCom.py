@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+
+################################################################################
+#
+#   \file
+#   \author     <a href="http://www.innomatic.ca">innomatic</a>
+#   \brief      Concurrent acquisition from multiple boards
+#   \copyright  <a rel="license" href="http://creativecommons.org/licenses/by-nc/4.0/"><img alt="Creative Commons Licence" style="border-width:0" src="https://i.creativecommons.org/l/by-nc/4.0/88x31.png" /></a><br />This work is licensed under a <a rel="license" href="http://creativecommons.org/licenses/by-nc/4.0/">Creative Commons Attribution-NonCommercial 4.0 International License</a>.
+#
+#   DeviceManager opens a number of ports at once, each one with its own
+#   AsyncDevice (reader and decoder), all served by a single asyncio event
+#   loop on one background thread. The reports of all the boards are merged
+#   into one stream of samples, each stamped with the time its bytes were
+#   read, which the caller (a wx.Timer handler, for instance) takes out in
+#   blocks with GetSamples().
+#
+#   @code
+#   dm = DeviceManager(['/dev/ttyACM0', '/dev/ttyACM1'])
+#   dm.Start()
+#   dm.Send(OutPackets['TSC Report Set'][2:-1])
+#
+#   # periodically
+#   times, devices, values = dm.GetSamples()
+#   for stat in dm.GetThroughput():
+#       print(stat['port'], stat['Bps'], stat['samplesps'])
+#   @endcode
+#
+
+import asyncio
+import concurrent.futures
+import threading
+import time
+from AsyncCom import *
+
+#--------1---------2---------3---------4---------5---------6---------7---------8
+class DeviceManager():
+
+    def __init__(self, ports, speed=115200, maxSamples=1000000):
+        self.ports = list(ports)
+        self.speed = speed
+        # devices (None if the port failed to open)
+        self.devices = [None] * len(self.ports)
+        self.errors = [None] * len(self.ports)
+        # report decoder
+        self.rd = ReportDecoder()
+        # merged stream: list of (times in ns, device index, values array)
+        self.batches = []
+        self.count = 0
+        self.maxSamples = maxSamples
+        self.dropped = 0
+        self.lock = threading.Lock()
+        # number of samples of each device, and of the packets left out as
+        # not a report or not of the type and size of the last one
+        self.samples = [0] * len(self.ports)
+        self.discarded = [0] * len(self.ports)
+        # counters at the previous GetThroughput()
+        self.lastTime = time.monotonic()
+        self.lastBytes = [0] * len(self.ports)
+        self.lastSamples = [0] * len(self.ports)
+        # event loop and its thread
+        self.loop = None
+        self.thread = None
+        self.stop = None
+        # packets being sent
+        self.sends = []
+
+    ## open the ports and start the acquisition thread; returns the number
+    # of ports opened
+    def Start(self):
+        started = threading.Event()
+        self.thread = threading.Thread(target=self._Run, args=(started,),
+                name='DeviceManager', daemon=True)
+        self.thread.start()
+        started.wait()
+        return len([dev for dev in self.devices if dev is not None])
+
+    ## stop the acquisition thread and close the ports. The packets sent
+    # before are written out first, waiting up to the timeout (seconds).
+    def Stop(self, timeout=1.0):
+        if self.loop is not None and self.thread.is_alive():
+            concurrent.futures.wait(self.sends, timeout)
+            self.sends = []
+            self.loop.call_soon_threadsafe(self.stop.set)
+            self.thread.join()
+
+    ## send a packet with the payload to one device or to all of them
+    def Send(self, payload, index=None):
+        targets = range(len(self.devices)) if index is None else [index]
+        self.sends = [f for f in self.sends if not f.done()]
+        for idx in targets:
+            if self.devices[idx] is not None:
+                self.sends.append(asyncio.run_coroutine_threadsafe(
+                        self.devices[idx].Send(payload), self.loop))
+
+    ## thread routine
+    def _Run(self, started):
+        asyncio.run(self._Main(started))
+
+    async def _Main(self, started):
+        self.loop = asyncio.get_running_loop()
+        self.stop = asyncio.Event()
+
+        # open all the ports
+        for idx, port in enumerate(self.ports):
+            dev = AsyncDevice(port, self.speed, 'PAYLOAD')
+            try:
+                await dev.Open()
+                self.devices[idx] = dev
+            except Exception as e:
+                self.errors[idx] = str(e)
+        started.set()
+
+        tasks = [asyncio.ensure_future(self._Collect(idx, dev))
+                for idx, dev in enumerate(self.devices) if dev is not None]
+
+        await self.stop.wait()
+
+        # what is written goes out before the ports are closed
+        devices = [dev for dev in self.devices if dev is not None]
+        await asyncio.gather(*[dev.Drain() for dev in devices])
+        for dev in devices:
+            dev.Close()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    ## collect the reports of a device into the merged stream
+    async def _Collect(self, idx, dev):
+        while True:
+            frame = await dev.GetFrame()
+            if frame is None:
+                break
+
+            # everything decoded so far with the times they were read
+            frames, stamps = dev.GetStampedFrames()
+            times, values = self._Decode([frame] + frames,
+                    [dev.stamp] + stamps)
+            self.discarded[idx] += len(frames) + 1 - len(values)
+            if len(values) == 0:
+                continue
+
+            with self.lock:
+                self.batches.append((times, idx, values))
+                self.count += len(values)
+                self.samples[idx] += len(values)
+
+                # drop the oldest
+                while self.count > self.maxSamples and len(self.batches) > 1:
+                    self.count -= len(self.batches[0][2])
+                    self.dropped += len(self.batches[0][2])
+                    del self.batches[0]
+
+    ## decode the reports of the type and size of the last one, and return
+    # their receive times and values
+    def _Decode(self, payloads, stamps):
+        reports = [(p, t) for p, t in zip(payloads, stamps)
+                if p and self.rd.GetChannels(p[0], len(p)) is not None]
+        if not reports:
+            return np.zeros(0, np.int64), np.zeros((0, 0))
+
+        code, length = reports[-1][0][0], len(reports[-1][0])
+        reports = [(p, t) for p, t in reports
+                if p[0] == code and len(p) == length]
+        values = self.rd.DecodeArray([p for p, t in reports], code,
+                self.rd.GetChannels(code, length))
+        return np.array([t for p, t in reports], np.int64), values
+
+    ## take out the merged samples in the order of their receive times as a
+    # tuple of arrays: times (ns, int64), device indices (int16) and values
+    # (n_samples, n_channels). Devices with fewer channels are padded with 0.
+    def GetSamples(self):
+        with self.lock:
+            batches, self.batches = self.batches, []
+            self.count = 0
+
+        if not batches:
+            return (np.zeros(0, np.int64), np.zeros(0, np.int16),
+                    np.zeros((0, 0), np.int64))
+
+        sizes = [len(b[2]) for b in batches]
+        times = np.concatenate([b[0] for b in batches])
+        devices = np.repeat(np.array([b[1] for b in batches], np.int16), sizes)
+
+        # pad to the widest report
+        channels = max(b[2].shape[1] for b in batches)
+        values = np.zeros((len(times), channels),
+                np.result_type(*[b[2].dtype for b in batches]))
+        row = 0
+        for size, (stamp, idx, data) in zip(sizes, batches):
+            values[row:row + size, :data.shape[1]] = data
+            row += size
+
+        # a batch may hold reads later than the batch of the next device
+        order = np.argsort(times, kind='stable')
+        return times[order], devices[order], values[order]
+
+    ## return the list of per-device statistics since the previous call
+    def GetThroughput(self):
+        now = time.monotonic()
+        span = max(now - self.lastTime, 1e-9)
+        self.lastTime = now
+
+        stats = []
+        for idx, dev in enumerate(self.devices):
+            rxBytes = dev.rxBytes if dev is not None else 0
+            samples = self.samples[idx]
+            stat = {
+                    'port': self.ports[idx],
+                    'open': dev is not None and dev.IsOpen(),
+                    'error': self.errors[idx],
+                    'bytes': rxBytes,
+                    'samples': samples,
+                    'discarded': self.discarded[idx],
+                    'Bps': (rxBytes - self.lastBytes[idx]) / span,
+                    'samplesps': (samples - self.lastSamples[idx]) / span,
+                    }
+            if dev is not None:
+                stat.update(dev.pd.GetStats())
+            stats.append(stat)
+
+            self.lastBytes[idx] = rxBytes
+            self.lastSamples[idx] = samples
+
+        return stats
+
+
+#--------1---------2---------3---------4---------5---------6---------7---------8
+if __name__=='__main__':
+    import sys
+
+    if len(sys.argv) < 2:
+        print('usage: MultiCom.py port [port ...]')
+        sys.exit(0)
+
+    dm = DeviceManager(sys.argv[1:])
+    print('{} of {} port(s) open'.format(dm.Start(), len(dm.ports)))
+    dm.Send(OutPackets['TSC Report Set'][2:-1])
+
+    # per-device throughput every second
+    try:
+        while True:
+            time.sleep(1)
+            times, devices, values = dm.GetSamples()
+            print('{} samples merged'.format(len(times)))
+            for stat in dm.GetThroughput():
+                print('  {:20s}{:10.0f} B/s{:8.0f} samples/s  {}'.format(
+                    stat['port'], stat['Bps'], stat['samplesps'],
+                    stat['error'] or ''))
+    except KeyboardInterrupt:
+        pass
+
+    dm.Send(OutPackets['TSC Report Clear'][2:-1])
+    dm.Stop()
@@ -0,0 +1,310 @@
+#!/usr/bin/env python3
+
+################################################################################
+#
+#   \file
+#   \author     <a href="http://www.innomatic.ca">innomatic</a>
+#   \brief      Throughput benchmark of the packet pipeline
+#   \copyright  <a rel="license" href="http://creativecommons.org/licenses/by-nc/4.0/"><img alt="Creative Commons Licence" style="border-width:0" src="https://i.creativecommons.org/l/by-nc/4.0/88x31.png" /></a><br />This work is licensed under a <a rel="license" href="http://creativecommons.org/licenses/by-nc/4.0/">Creative Commons Attribution-NonCommercial 4.0 International License</a>.
+#
+#   Synthetic streams are built from the OutPackets and from TSC reports, with
+#   optional noise bytes and checksum errors, and fed to the decoders. Neither
+#   wx nor the serial port is needed. The result is printed and optionally
+#   written in JSON, which can be given back as a baseline to catch
+#   regressions. Each Feed() case is also compared with the AddByte() case
+#   of the same mode and stream; the chunk path is expected to be faster,
+#   and at least 'target' times faster in every mode on the report stream.
+#   The exit status is non zero if any of these fails.
+#
+#   The target does not apply to the command and the mixed streams, where
+#   the length changes from a packet to the next and Feed() checks the
+#   packets one by one (about 1.5x).
+#
+#   \verbatim
+#   python3 PacketBench.py --size 1 --output bench.json
+#   python3 PacketBench.py --size 1 --noise 0.01 --errors 0.01
+#   python3 PacketBench.py --baseline bench.json --tolerance 0.2
+#   python3 PacketBench.py --target 10
+#   \endverbatim
+#
+
+import argparse
+import itertools
+import json
+import platform
+import random
+import struct
+import sys
+import time
+from SerialCom import *
+
+#--------1---------2---------3---------4---------5---------6---------7---------8
+## Return the list of TSC report packets with random walk counts
+def MakeReports(count=1024, channels=2, seed=0):
+    rnd = random.Random(seed)
+    values = [1000] * channels
+    packets = []
+
+    for idx in range(count):
+        # slow drift of the touch counts
+        values = [min(max(v + rnd.randint(-8, 8), 0), 0xffff) for v in values]
+        packets.append(MakePacket(struct.pack('>B{:d}H'.format(channels),
+            RPT_U16XXX, *values)))
+
+    return packets
+
+## Return the list of command packets followed by the replies
+def MakeCommands():
+    packets = []
+
+    for packet in OutPackets.values():
+        packets.append(packet)
+        packets.append(bytes((PKT_ACK,)))
+
+    return packets
+
+## Return the reports interleaved with the commands and their replies, so
+# the length changes from a packet to the next
+def MakeMixed(seed=0):
+    packets = []
+
+    for report, command in zip(MakeReports(256, seed=seed),
+            itertools.cycle(MakeCommands())):
+        packets.append(report)
+        packets.append(command)
+
+    return packets
+
+## Build a stream of given size out of the packets
+#
+# * noise: probability of random bytes between the packets
+# * errors: probability of checksum error of a packet
+#
+def MakeStream(packets, size, noise=0.0, errors=0.0, seed=0):
+    rnd = random.Random(seed)
+    stream = bytearray()
+
+    while len(stream) < size:
+        for packet in packets:
+            # corrupt the checksum
+            if errors and rnd.random() < errors and len(packet) > 1:
+                packet = packet[:-1] + bytes((packet[-1] ^ 0xff,))
+            stream += packet
+
+            # line noise
+            if noise and rnd.random() < noise:
+                stream += bytes(rnd.randrange(256)
+                        for x in range(rnd.randint(1, 4)))
+
+    return bytes(stream[:size])
+
+## Split the stream into the chunks of given size
+def Chunks(stream, size):
+    return [stream[idx:idx + size] for idx in range(0, len(stream), size)]
+
+#--------1---------2---------3---------4---------5---------6---------7---------8
+## Return the list of (name, function) of the benchmark cases. Each function
+# takes the list of chunks and returns the number of packets it produced.
+def MakeCases():
+    cases = []
+
+    # byte by byte decoding
+    def AddByteCase(mode):
+        def run(chunks):
+            pd = PacketDecoder(mode)
+            count = 0
+            for chunk in chunks:
+                for byte in chunk:
+                    if pd.AddByte(byte) is not None:
+                        count += 1
+            return count
+        return run
+
+    # chunk decoding
+    def FeedCase(mode, resync=False):
+        def run(chunks):
+            pd = PacketDecoder(mode, resync)
+            count = 0
+            for chunk in chunks:
+                count += len(pd.Feed(chunk))
+            return count
+        return run
+
+    for mode in ('FULL', 'PAYLOAD', 'DECODE'):
+        cases.append(('addbyte-' + mode.lower(), AddByteCase(mode)))
+        cases.append(('feed-' + mode.lower(), FeedCase(mode)))
+    cases.append(('feed-resync', FeedCase('PAYLOAD', True)))
+
+    # report decoding one packet at a time
+    def ReportCase(chunks):
+        pd = PacketDecoder('PAYLOAD')
+        rd = ReportDecoder()
+        count = 0
+        for chunk in chunks:
+            for payload in pd.Feed(chunk):
+                if rd.Decode(payload) is not None:
+                    count += 1
+        return count
+    cases.append(('feed-report', ReportCase))
+
+    # numpy batch decoding
+    def ArrayCase(chunks):
+        pd = PacketDecoder('PAYLOAD')
+        rd = ReportDecoder()
+        count = 0
+        for chunk in chunks:
+            count += len(rd.DecodeArray(pd.Feed(chunk)))
+        return count
+
+    if np is not None:
+        cases.append(('feed-array', ArrayCase))
+
+    return cases
+
+## Run the case and return the best time of the repeats and the packet count
+def RunCase(func, chunks, repeat):
+    best = None
+
+    for idx in range(repeat):
+        start = time.perf_counter()
+        count = func(chunks)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+
+    return best, count
+
+## Run all the cases on all the streams and return the report
+def RunBench(size, noise=0.0, errors=0.0, chunk=4096, repeat=3,
+        select=None, seed=0):
+    streams = {
+            'report': MakeStream(MakeReports(seed=seed), size, noise, errors,
+                seed),
+            'command': MakeStream(MakeCommands(), size, noise, errors, seed),
+            'mixed': MakeStream(MakeMixed(seed), size, noise, errors, seed),
+            }
+
+    results = []
+    for sname, stream in streams.items():
+        chunks = Chunks(stream, chunk)
+
+        for cname, func in MakeCases():
+            name = sname + '/' + cname
+            # run selected cases only
+            if select and not any(s in name for s in select):
+                continue
+
+            elapsed, count = RunCase(func, chunks, repeat)
+            results.append({
+                'name': name,
+                'seconds': elapsed,
+                'bytes': len(stream),
+                'packets': count,
+                'MBps': len(stream) / elapsed / 1e6,
+                'packetsps': count / elapsed,
+                })
+
+    # speed of the chunk path against the byte by byte one
+    speeds = {r['name']: r['MBps'] for r in results}
+    for r in results:
+        base = r['name'].replace('/feed-', '/addbyte-')
+        r['vsAddByte'] = r['MBps'] / speeds[base] \
+                if base != r['name'] and base in speeds else None
+
+    return {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'numpy': np.__version__ if np is not None else None,
+            'size': size,
+            'noise': noise,
+            'errors': errors,
+            'chunk': chunk,
+            'repeat': repeat,
+            'results': results,
+            }
+
+## Compare the results with the baseline report and return the list of cases
+# slower than the baseline by more than the tolerance
+def Compare(report, baseline, tolerance):
+    base = {r['name']: r for r in baseline['results']}
+    slow = []
+
+    for r in report['results']:
+        if r['name'] in base and \
+                r['MBps'] < base[r['name']]['MBps'] * (1.0 - tolerance):
+            slow.append((r['name'], base[r['name']]['MBps'], r['MBps']))
+
+    return slow
+
+## Return the list of (name, ratio) of the Feed() cases of the report stream
+# less than target times faster than AddByte()
+def MissTarget(report, target):
+    return [(r['name'], r['vsAddByte']) for r in report['results']
+            if r['name'].startswith('report/') and r['vsAddByte'] is not None
+            and r['vsAddByte'] < target]
+
+#--------1---------2---------3---------4---------5---------6---------7---------8
+if __name__=='__main__':
+
+    parser = argparse.ArgumentParser(
+            description='Throughput benchmark of the packet pipeline')
+    parser.add_argument('--size', type=float, default=1.0,
+            help='stream size in MB (default: 1)')
+    parser.add_argument('--noise', type=float, default=0.0,
+            help='probability of noise bytes after a packet')
+    parser.add_argument('--errors', type=float, default=0.0,
+            help='probability of checksum error of a packet')
+    parser.add_argument('--chunk', type=int, default=4096,
+            help='chunk size in bytes (default: 4096)')
+    parser.add_argument('--repeat', type=int, default=3,
+            help='number of runs of each case, best one is taken')
+    parser.add_argument('--select', nargs='*',
+            help='run the cases whose name contains any of these')
+    parser.add_argument('--output', help='write the report in JSON')
+    parser.add_argument('--baseline', help='compare with the JSON report')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+            help='allowed slowdown against the baseline (default: 0.2)')
+    parser.add_argument('--target', type=float, default=10.0,
+            help='minimum speedup of Feed() over AddByte() on the report '
+            'stream (default: 10)')
+    args = parser.parse_args()
+
+    report = RunBench(int(args.size * 1e6), args.noise, args.errors,
+            args.chunk, args.repeat, args.select)
+
+    print('{:28s}{:>10s}{:>14s}{:>10s}{:>10s}'.format('case', 'MB/s',
+        'packets/s', 'packets', 'xAddByte'))
+    for r in report['results']:
+        ratio = '' if r['vsAddByte'] is None else \
+                '{:.2f}'.format(r['vsAddByte'])
+        print('{:28s}{:10.2f}{:14.0f}{:10d}{:>10s}'.format(r['name'],
+            r['MBps'], r['packetsps'], r['packets'], ratio))
+
+    # chunk decoding should never lose to the byte by byte decoding
+    failed = False
+    for r in report['results']:
+        if r['vsAddByte'] is not None and r['vsAddByte'] < 1.0:
+            print('SLOWER THAN ADDBYTE {}: {:.2f}x'.format(r['name'],
+                r['vsAddByte']))
+            failed = True
+
+    # and be well ahead of it on the reports
+    for name, ratio in MissTarget(report, args.target):
+        print('BELOW TARGET {}: {:.2f}x < {:.0f}x'.format(name, ratio,
+            args.target))
+        failed = True
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            slow = Compare(report, json.load(f), args.tolerance)
+
+        for name, old, new in slow:
+            print('REGRESSION {}: {:.2f} -> {:.2f} MB/s'.format(name, old, new))
+        failed = failed or bool(slow)
+
+    # non zero exit status for the scripts
+    sys.exit(1 if failed else 0)
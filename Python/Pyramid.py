@@ -0,0 +1,342 @@
+#!/usr/bin/env python3
+
+################################################################################
+#
+#   \file
+#   \author     <a href="http://www.innomatic.ca">innomatic</a>
+#   \brief      Multi-resolution summaries of the whole sample history
+#   \copyright  <a rel="license" href="http://creativecommons.org/licenses/by-nc/4.0/"><img alt="Creative Commons Licence" style="border-width:0" src="https://i.creativecommons.org/l/by-nc/4.0/88x31.png" /></a><br />This work is licensed under a <a rel="license" href="http://creativecommons.org/licenses/by-nc/4.0/">Creative Commons Attribution-NonCommercial 4.0 International License</a>.
+#
+#   SummaryPyramid keeps every sample of the session (level 0) and above it
+#   levels of the minimum, the maximum and the sum of 'fanout' entries of
+#   the level below, so an entry of level k covers fanout**k samples. The
+#   levels are extended as the samples arrive.
+#
+#   Query() picks the coarsest level that still has an entry per pixel for
+#   the range, takes the rest of the range from the finer levels, and
+#   reduces the entries to one per pixel. The cost depends on the number of
+#   pixels, not on the length of the range.
+#
+#   The levels are kept in memory, or in files of a directory (np.memmap)
+#   for sessions larger than the memory. In memory an array is copied each
+#   time it doubles; the files are only made longer and mapped again, so
+#   use them for a session of unknown length.
+#
+#   SetChannels() adds channels (zero until then) to the levels, keeping the
+#   samples so far.
+#
+#   @code
+#   sp = SummaryPyramid(2)
+#   sp.Extend(data)                         # (n_samples, n_channels) block
+#   x, low, high, mean = sp.Query(0, sp.Count(), 800)
+#   x, ys = sp.Envelope(0, sp.Count(), 800) # for WplGraph.DrawStream()
+#   @endcode
+#
+
+import math
+import os
+import numpy as np
+
+#--------1---------2---------3---------4---------5---------6---------7---------8
+##
+# \brief    Array growing along the first axis, in memory or in a file
+#
+class GrowArray:
+
+    def __init__(self, channels, path=None, capacity=1024):
+        self.channels = channels
+        self.path = path
+        self.count = 0
+        if path is not None:
+            # start a new file
+            open(path, 'wb').close()
+        self.data = self._Alloc(capacity)
+
+    def _Alloc(self, capacity):
+        if self.path is None:
+            return np.empty((capacity, self.channels))
+
+        with open(self.path, 'r+b') as f:
+            f.truncate(capacity * self.channels * 8)
+        return np.memmap(self.path, np.float64, 'r+',
+                shape=(capacity, self.channels))
+
+    def __len__(self):
+        return self.count
+
+    ## Add channels, zero for the entries so far
+    def SetChannels(self, channels):
+        if channels <= self.channels:
+            return
+
+        capacity = len(self.data)
+        if self.path is None:
+            data = np.zeros((capacity, channels))
+            data[:self.count, :self.channels] = self.data[:self.count]
+            self.data = data
+        else:
+            # the rows get longer: copy into a new file and map it instead
+            temp = self.path + '.tmp'
+            with open(temp, 'wb') as f:
+                f.truncate(capacity * channels * 8)
+            data = np.memmap(temp, np.float64, 'r+',
+                    shape=(capacity, channels))
+            data[:self.count, :self.channels] = self.data[:self.count]
+            data.flush()
+            data = None
+            self.data = None
+            os.replace(temp, self.path)
+            self.data = np.memmap(self.path, np.float64, 'r+',
+                    shape=(capacity, channels))
+        self.channels = channels
+
+    def Extend(self, block):
+        need = self.count + len(block)
+        if need > len(self.data):
+            capacity = max(need, 2 * len(self.data))
+            if self.path is None:
+                data = self._Alloc(capacity)
+                data[:self.count] = self.data[:self.count]
+                self.data = data
+            else:
+                # the file keeps the data, map it again larger (no flush:
+                # the pages stay in the cache, writing them out would stall)
+                self.data = None
+                self.data = self._Alloc(capacity)
+        self.data[self.count:need] = block
+        self.count = need
+
+    ## return the entries from start to end (view valid until Extend)
+    def View(self, start=0, end=None):
+        if end is None or end > self.count:
+            end = self.count
+        return self.data[start:end]
+
+    def Close(self):
+        if isinstance(self.data, np.memmap):
+            self.data.flush()
+        self.data = None
+
+##
+# \brief    Entries of a level: minimum, maximum and sum (the same array for
+#           the samples of level 0)
+#
+class SummaryLevel:
+
+    def __init__(self, channels, path=None, level=0):
+        def Name(kind):
+            if path is None:
+                return None
+            return os.path.join(path, 'level{:d}-{}.f8'.format(level, kind))
+
+        if level == 0:
+            self.low = self.high = self.sum = GrowArray(channels, Name('raw'))
+        else:
+            self.low = GrowArray(channels, Name('min'))
+            self.high = GrowArray(channels, Name('max'))
+            self.sum = GrowArray(channels, Name('sum'))
+
+    def __len__(self):
+        return len(self.low)
+
+    def SetChannels(self, channels):
+        for array in {self.low, self.high, self.sum}:
+            array.SetChannels(channels)
+
+    def Close(self):
+        for array in {self.low, self.high, self.sum}:
+            array.Close()
+
+##
+# \brief    Level-of-detail summaries of the samples
+#
+class SummaryPyramid:
+
+    def __init__(self, channels=1, fanout=8, path=None):
+        self.channels = max(int(channels), 1)
+        self.fanout = max(int(fanout), 2)
+        # directory of the level files, None for memory
+        self.path = path
+        if path is not None:
+            os.makedirs(path, exist_ok=True)
+        self.levels = [SummaryLevel(self.channels, path, 0)]
+
+    ## Return the number of samples
+    def Count(self):
+        return len(self.levels[0])
+
+    ## Add channels to the samples so far, with the value of zero. Fewer
+    # channels are ignored: give the blocks zero for them instead.
+    def SetChannels(self, channels):
+        channels = int(channels)
+        if channels <= self.channels:
+            return
+        for level in self.levels:
+            level.SetChannels(channels)
+        self.channels = channels
+
+    ## Add a block of samples (n_samples, n_channels)
+    def Extend(self, block):
+        block = np.asarray(block, np.float64)
+        if block.ndim == 1:
+            block = block.reshape(-1, 1)
+        if len(block) == 0:
+            return
+        self.levels[0].low.Extend(block)
+
+        # summarize the complete groups of each level in the one above
+        for k in range(1, 64):
+            below = self.levels[k - 1]
+            complete = len(below) // self.fanout
+            if complete == 0:
+                break
+            if k == len(self.levels):
+                self.levels.append(SummaryLevel(self.channels, self.path, k))
+
+            level = self.levels[k]
+            if complete == len(level):
+                break
+            start = len(level) * self.fanout
+            end = complete * self.fanout
+            shape = (-1, self.fanout, self.channels)
+            level.low.Extend(below.low.View(start, end).reshape(shape)
+                    .min(axis=1))
+            level.high.Extend(below.high.View(start, end).reshape(shape)
+                    .max(axis=1))
+            level.sum.Extend(below.sum.View(start, end).reshape(shape)
+                    .sum(axis=1))
+
+    ## Return x (first sample), minimum, maximum and mean of the samples
+    # from start to end, reduced to at most 'pixels' entries
+    def Query(self, start, end, pixels):
+        start = max(int(start), 0)
+        end = min(int(math.ceil(end)), self.Count())
+        pixels = max(int(pixels), 1)
+        if end <= start:
+            empty = np.empty((0, self.channels))
+            return np.empty(0, np.int64), empty, empty, empty
+
+        # coarsest level with at least an entry per pixel
+        span = end - start
+        top = 0
+        while (top + 1 < len(self.levels) and
+                self.fanout ** (top + 1) <= span / pixels):
+            top += 1
+
+        # from the coarse level, the rest of the range from the finer ones
+        parts = []
+        pos = start
+        for k in range(top, -1, -1):
+            size = self.fanout ** k
+            level = self.levels[k]
+            first = pos // size
+            last = min(-(-end // size), len(level))
+            if last <= first:
+                continue
+            parts.append((np.arange(first, last) * size,
+                level.low.View(first, last), level.high.View(first, last),
+                level.sum.View(first, last), np.full(last - first, size)))
+            pos = last * size
+            if pos >= end:
+                break
+
+        starts, low, high, total, counts = [np.concatenate(p)
+                for p in zip(*parts)]
+
+        # entries of each pixel (in order, so runs of the same pixel)
+        pix = (np.maximum(starts, start) - start) * pixels // span
+        idx = np.flatnonzero(np.diff(pix, prepend=-1))
+        low = np.minimum.reduceat(low, idx, axis=0)
+        high = np.maximum.reduceat(high, idx, axis=0)
+        mean = (np.add.reduceat(total, idx, axis=0) /
+                np.add.reduceat(counts, idx)[:, None])
+        return np.maximum(starts[idx], start), low, high, mean
+
+    ## Return x and ys (n_channels, n_points) of the min/max envelope of
+    # the samples from start to end, two points per pixel
+    def Envelope(self, start, end, pixels):
+        x, low, high, mean = self.Query(start, end, pixels)
+        points = np.repeat(x, 2).astype(np.float64)
+        ys = np.empty((self.channels, len(points)))
+        ys[:, 0::2] = low.T
+        ys[:, 1::2] = high.T
+        return points, ys
+
+    def Close(self):
+        for level in self.levels:
+            level.Close()
+
+
+#--------1---------2---------3---------4---------5---------6---------7---------8
+if __name__=='__main__':
+    import random
+    import tempfile
+    import time
+    print('Unit Test for SummaryPyramid()')
+
+    # against the samples, in memory and in files
+    rnd = random.Random(0)
+    data = np.array([[rnd.gauss(0, 1), rnd.randrange(1000)]
+        for x in range(20000)])
+    with tempfile.TemporaryDirectory() as path:
+        for where in (None, path):
+            sp = SummaryPyramid(2, 4, where)
+            pos = 0
+            while pos < len(data):
+                count = rnd.randrange(300)
+                sp.Extend(data[pos:pos + count])
+                pos += count
+
+            ok = True
+            for test in range(200):
+                start = rnd.randrange(len(data))
+                end = rnd.randrange(start + 1, len(data) + 1)
+                pixels = rnd.randrange(1, 500)
+                x, low, high, mean = sp.Query(start, end, pixels)
+                # the whole range: exact; with the entries over the edges:
+                # at least as wide
+                ok = ok and len(x) <= pixels and x[0] == start
+                ok = ok and np.all(low.min(axis=0) <=
+                        data[start:end].min(axis=0))
+                ok = ok and np.all(high.max(axis=0) >=
+                        data[start:end].max(axis=0))
+            full = sp.Query(0, len(data), 100)
+            exact = (np.array_equal(full[1].min(axis=0), data.min(axis=0)) and
+                    np.allclose((full[3] * np.diff(np.append(full[0],
+                        len(data)))[:, None]).sum(axis=0), data.sum(axis=0)))
+            print('levels', len(sp.levels), 'queries ok', ok, 'exact', exact,
+                    'in', 'memory' if where is None else 'files')
+            sp.Close()
+
+    # channels added during the session
+    with tempfile.TemporaryDirectory() as path:
+        for where in (None, path):
+            sp = SummaryPyramid(1, 4, where)
+            sp.Extend(data[:10000, :1])
+            sp.SetChannels(2)
+            sp.Extend(data[10000:])
+            ref = data.copy()
+            ref[:10000, 1] = 0
+            x, low, high, mean = sp.Query(0, len(data), 1)
+            print('channels added: same as padded',
+                    np.array_equal(low[0], ref.min(axis=0)) and
+                    np.array_equal(high[0], ref.max(axis=0)) and
+                    np.allclose(mean[0], ref.mean(axis=0)),
+                    'in', 'memory' if where is None else 'files')
+            sp.Close()
+
+    # an hour of 1 kHz reports, 8 channels
+    sp = SummaryPyramid(8)
+    block = np.random.default_rng(0).normal(size=(1000, 8))
+    start = time.perf_counter()
+    for count in range(3600):
+        sp.Extend(block)
+    elapsed = time.perf_counter() - start
+    print('extend {:.0f} us per 1000 samples, {} levels'.format(
+        elapsed / 3600 * 1e6, len(sp.levels)))
+    for span in (3600000, 60000, 1000):
+        start = time.perf_counter()
+        for count in range(100):
+            x, ys = sp.Envelope(1000000, 1000000 + span, 1000)
+        print('{:8d} samples on 1000 pixels: {:.2f} ms, {} points'.format(
+            span, (time.perf_counter() - start) * 10, len(x)))
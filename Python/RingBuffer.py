@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+
+################################################################################
+#
+#   \file
+#   \author     <a href="http://www.innomatic.ca">innomatic</a>
+#   \brief      Fixed size sample history on a NumPy array
+#   \copyright  <a rel="license" href="http://creativecommons.org/licenses/by-nc/4.0/"><img alt="Creative Commons Licence" style="border-width:0" src="https://i.creativecommons.org/l/by-nc/4.0/88x31.png" /></a><br />This work is licensed under a <a rel="license" href="http://creativecommons.org/licenses/by-nc/4.0/">Creative Commons Attribution-NonCommercial 4.0 International License</a>.
+#
+#   RingBuffer keeps the last 'size' samples of a number of channels. Every
+#   sample is stored twice, at its position in the ring and once more one
+#   ring further, so the samples from the oldest to the newest are always
+#   contiguous in memory and View() returns them without copying.
+#
+#   @code
+#   rb = RingBuffer(1000, 2)
+#   rb.Extend(data)         # (n_samples, n_channels) block
+#   rb.Append((1000, 1020)) # one sample
+#   view = rb.View()        # (1000, 2), oldest first, no copy
+#   rb.Resize(5000)         # the newest 1000 samples are kept
+#   @endcode
+#
+#   Views are valid until the next change of the buffer; take a copy to keep
+#   them longer.
+#
+
+import numpy as np
+
+#--------1---------2---------3---------4---------5---------6---------7---------8
+class RingBuffer:
+
+    def __init__(self, size, channels=1, dtype=np.float64, fill=0):
+        self.size = max(int(size), 1)
+        self.channels = max(int(channels), 1)
+        self.dtype = np.dtype(dtype)
+        self.fill = fill
+        # storage of two rings
+        self.buffer = np.full((2 * self.size, self.channels), fill,
+                self.dtype)
+        # position of the oldest sample and the number of samples written
+        self.head = 0
+        self.count = 0
+
+    def __len__(self):
+        return self.size
+
+    ## Return the number of samples written, up to the size
+    def Count(self):
+        return min(self.count, self.size)
+
+    ## Add one sample (a value per channel)
+    def Append(self, sample):
+        tail = self.head
+        self.buffer[tail] = sample
+        self.buffer[tail + self.size] = sample
+        self.head = (self.head + 1) % self.size
+        self.count += 1
+
+    ## Add a block of samples (n_samples, n_channels); a 1-D block is one
+    # channel. Only the last 'size' samples of a large block are kept.
+    def Extend(self, block):
+        block = np.asarray(block, self.dtype)
+        if block.ndim == 1:
+            block = block.reshape(-1, 1)
+        if len(block) == 0:
+            return
+
+        self.count += len(block)
+        if len(block) >= self.size:
+            block = block[-self.size:]
+            self.buffer[:self.size] = block
+            self.buffer[self.size:] = block
+            self.head = 0
+            return
+
+        # the block in the first ring (wraps around at the end)
+        first = min(len(block), self.size - self.head)
+        self.buffer[self.head:self.head + first] = block[:first]
+        self.buffer[:len(block) - first] = block[first:]
+        # the same in the second ring
+        self.buffer[self.size + self.head:self.size + self.head + first] = \
+                block[:first]
+        self.buffer[self.size:self.size + len(block) - first] = block[first:]
+        self.head = (self.head + len(block)) % self.size
+
+    ## Return the ordered view (oldest first) of the last count samples
+    # (default: the whole ring, including the fill values not written yet)
+    def View(self, count=None):
+        if count is None or count > self.size:
+            count = self.size
+        return self.buffer[self.head + self.size - count:
+                self.head + self.size]
+
+    ## Return the ordered view of a channel
+    def Channel(self, idx, count=None):
+        return self.View(count)[:, idx]
+
+    ## Change the size, keeping the newest samples. New slots are filled
+    # with the fill value at the old end.
+    def Resize(self, size):
+        size = max(int(size), 1)
+        if size == self.size:
+            return
+
+        keep = self.View(min(size, self.size)).copy()
+        self.buffer = np.full((2 * size, self.channels), self.fill,
+                self.dtype)
+        self.size = size
+        self.head = 0
+        self.count = min(self.count, len(keep))
+        # newest at the end of the ring
+        self.buffer[size - len(keep):size] = keep
+        self.buffer[2 * size - len(keep):] = keep
+
+    ## Change the number of channels, keeping the data of the existing ones
+    def SetChannels(self, channels):
+        channels = max(int(channels), 1)
+        if channels == self.channels:
+            return
+
+        buffer = np.full((2 * self.size, channels), self.fill, self.dtype)
+        common = min(channels, self.channels)
+        buffer[:, :common] = self.buffer[:, :common]
+        self.buffer = buffer
+        self.channels = channels
+
+    ## Forget all the samples
+    def Clear(self):
+        self.buffer[:] = self.fill
+        self.head = 0
+        self.count = 0
+
+
+#--------1---------2---------3---------4---------5---------6---------7---------8
+if __name__=='__main__':
+    print('Unit Test for RingBuffer()')
+
+    rb = RingBuffer(5, 2, np.int64)
+    for idx in range(7):
+        rb.Append((idx, -idx))
+    print('append:', rb.View()[:, 0], 'count', rb.Count())
+
+    rb.Extend(np.arange(100, 103).reshape(-1, 1).repeat(2, 1))
+    print('extend:', rb.View()[:, 0], 'view shares memory',
+            np.shares_memory(rb.View(), rb.buffer))
+
+    rb.Extend(np.arange(200, 212).reshape(-1, 1).repeat(2, 1))
+    print('large block:', rb.View()[:, 0])
+
+    rb.Resize(8)
+    print('grow:', rb.View()[:, 0])
+    rb.Resize(3)
+    print('shrink:', rb.View()[:, 0], 'last 2', rb.View(2)[:, 0])
+
+    rb.SetChannels(3)
+    rb.Append((1, 2, 3))
+    print('channels:', rb.View().tolist())
+
+    # against a list implementation
+    import random
+    rnd = random.Random(0)
+    rb = RingBuffer(50)
+    ref = [0] * 50
+    for step in range(1000):
+        block = [rnd.random() for x in range(rnd.randrange(80))]
+        rb.Extend(block)
+        ref = (ref + block)[-50:]
+    print('random blocks:', np.array_equal(rb.Channel(0), ref))
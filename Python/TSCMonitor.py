@@ -7,10 +7,20 @@
 #   \copyright  <a rel="license" href="http://creativecommons.org/licenses/by-nc/4.0/"><img alt="Creative Commons Licence" style="border-width:0" src="https://i.creativecommons.org/l/by-nc/4.0/88x31.png" /></a><br />This work is licensed under a <a rel="license" href="http://creativecommons.org/licenses/by-nc/4.0/">Creative Commons Attribution-NonCommercial 4.0 International License</a>.
 #
 
-import statistics as st
+import numpy as np
+import tempfile
 import wx
 from wxTerm import *
 from wplGraph import *
+from RingBuffer import RingBuffer
+from Decimator import MinMaxDecimator
+from Pyramid import SummaryPyramid
+
+# COM data delivery rate (per second) of the shown and the hidden page
+shownRate = 30
+hiddenRate = 2
+# maximum frame rate of the graph
+maxFps = 30
 
 #--------1---------2---------3---------4---------5---------6---------7---------8
 ##
@@ -30,10 +40,14 @@ class GraphPanel(wx.Panel):
                 size = (200,-1))
         self.lscStats.InsertColumn(0,'Item',width=120)
         self.lscStats.InsertColumn(1, 'Value')
+        # latency display
+        self.lscLatency = wx.ListCtrl(self.pnlControl, style = wx.LC_REPORT,
+                size = (200,110))
         self.sttDSize = wx.StaticText(self.pnlControl, label='Data Size')
         # data size dropdown
         self.choDSize = wx.Choice(self.pnlControl,
-                choices=['100','200','500','1000'])
+                choices=['100','200','500','1000','10000','100000',
+                    '1000000'])
 
         # run button
         self.tglRun = wx.ToggleButton(self.pnlControl, label='RUN')
@@ -44,6 +58,7 @@ class GraphPanel(wx.Panel):
 
         sizer_v = wx.BoxSizer(wx.VERTICAL)
         sizer_v.Add(self.lscStats, 1, wx.ALL|wx.EXPAND, 4)
+        sizer_v.Add(self.lscLatency, 0, wx.ALL|wx.EXPAND, 4)
         sizer_v.Add(sizer_h, 0, wx.ALL|wx.EXPAND, 4)
         sizer_v.Add(self.tglRun, 0, wx.ALL|wx.EXPAND, 4)
         self.pnlControl.SetSizer(sizer_v)
@@ -53,42 +68,77 @@ class GraphPanel(wx.Panel):
         self.choDSize.Bind(wx.EVT_CHOICE, self.OnNewDataSize)
         self.tglRun.Bind(wx.EVT_TOGGLEBUTTON, self.OnGraphRun)
 
+        # latency display update
+        self.tmrLatency = wx.Timer(self)
+        self.Bind(wx.EVT_TIMER, self.OnLatencyTimer, self.tmrLatency)
+        self.tmrLatency.Start(1000)
+        # graph redraw, no faster than the frame rate
+        self.tmrDraw = wx.Timer(self)
+        self.Bind(wx.EVT_TIMER, self.OnDrawTimer, self.tmrDraw)
+
         sizer_h = wx.BoxSizer(wx.HORIZONTAL)
         sizer_h.Add(self.grpTouch, 1, wx.ALL|wx.EXPAND, 4)
         sizer_h.Add(self.pnlControl, 0, wx.ALL|wx.EXPAND, 4)
         self.SetSizer(sizer_h)
 
-        # raw data storage
-        self.index = None
+        # sample history of the channels and its min/max envelope
+        self.history = None
+        self.decimator = None
+        # summaries of all the samples of the session for pan and zoom, in
+        # files so that they grow without copying however long it runs
+        self.pyramidDir = tempfile.TemporaryDirectory(prefix='tscmon-')
+        self.pyramid = SummaryPyramid(2, path=self.pyramidDir.name)
+        # sample of the session at x = 0, and the x range of the last frame
+        # if set with the toolbar
+        self.origin = 0
+        self.lastRange = None
+        # number of channels in the reports
+        self.channels = 0
+        # new data since the last frame and their receive times
+        self.dirty = False
+        self.pending = []
         self.SetGraphRange(100)
         self.choDSize.SetSelection(0)
-        # packet decoder
-        self.pd = PacketDecoder()
-        self.pd.SetMode('payload')
+        # report decoder
+        self.rd = ReportDecoder()
         # graph colors
         self.grpColor = ['ORANGE RED','CORNFLOWER BLUE','DARK OLIVE GREEN',
                 'VIOLET RED','SLATE BLUE','SPRING GREEN','MAROON','YELLOW GREEN']
         # graph run flag
         self.grpRun = False
+        # latency histograms ('draw' is added here)
+        self.latency = LatencyMonitor()
+        self.ShowLatency()
+        self.SetMaxFps(maxFps)
+
+    ## Set the maximum frame rate of the graph (per second, above 0)
+    def SetMaxFps(self, fps):
+        if not fps > 0:
+            raise ValueError('frame rate must be positive: ' + str(fps))
+        self.tmrDraw.Start(max(int(1000 / fps), 1))
+
+    ## Close the summaries and remove their files
+    def CloseHistory(self):
+        self.pyramid.Close()
+        self.pyramidDir.cleanup()
+
+    ## Set the latency monitor shared with the COM thread
+    def SetLatencyMonitor(self, latency):
+        self.latency = latency
+        self.ShowLatency()
 
 
     def SetGraphRange(self, count):
         # create a new set of data
-        if self.index is None:
-            self.index = [x for x in range(0,count)]
-            self.value = [[0]*count,[0]*count]
-        # modify existing
+        if self.history is None:
+            self.history = RingBuffer(count, 2)
+            self.decimator = MinMaxDecimator(count, 2)
+        # modify existing, the newest samples are kept
         else:
-            old_count = len(self.index)
-            self.index = [x for x in range(0,count)]
-            # decrease size
-            if count < old_count:
-                for idx in range(len(self.value)):
-                    self.value[idx] = self.value[idx][old_count-count:]
-            # increase size
-            else:
-                for idx in range(len(self.value)):
-                    self.value[idx] = [0] * (count-old_count) + self.value[idx]
+            self.history.Resize(count)
+            self.decimator.Reset(size=count, samples=self.history.View(
+                self.history.Count()))
+        self.dirty = True
 
 
     def OnNewDataSize(self, evt):
@@ -100,6 +150,7 @@ class GraphPanel(wx.Panel):
         if self.tglRun.GetValue():
             self.grpRun = True
             self.tglRun.SetLabel('PAUSE')
+            self.dirty = True
         else:
             self.grpRun = False
             self.tglRun.SetLabel('RUN')
@@ -109,47 +160,125 @@ class GraphPanel(wx.Panel):
         self.lscStats.ClearAll()
         self.lscStats.InsertColumn(0,'Item',width=120)
         self.lscStats.InsertColumn(1, 'Value')
-        for idx in range(len(self.value)):
+        # samples received only
+        view = self.history.View(self.history.Count())
+        if len(view) < 2:
+            return
+        for idx in range(view.shape[1]):
+            value = view[:,idx]
             self.lscStats.InsertItem(5*idx,'Touch {:d} max'.format(idx))
             self.lscStats.SetItem(5*idx,1,
-                    '{:d}'.format(max(self.value[idx])))
+                    '{:d}'.format(int(value.max())))
             self.lscStats.InsertItem(5*idx+1,'Touch {:d} min'.format(idx))
             self.lscStats.SetItem(5*idx+1,1,
-                    '{:d}'.format(min(self.value[idx])))
+                    '{:d}'.format(int(value.min())))
             self.lscStats.InsertItem(5*idx+2,'Touch {:d} mean'.format(idx))
             self.lscStats.SetItem(5*idx+2,1,
-                    '{:.1f}'.format(st.mean(self.value[idx])))
+                    '{:.1f}'.format(value.mean()))
             self.lscStats.InsertItem(5*idx+3,'Touch {:d} stdev'.format(idx))
             self.lscStats.SetItem(5*idx+3,1,
-                    '{:.2f}'.format(st.stdev(self.value[idx])))
+                    '{:.2f}'.format(value.std(ddof=1)))
             self.lscStats.InsertItem(5*idx+4,'')
 
+    ## Show the median and the 99th percentile latency of each stage (ms)
+    def ShowLatency(self):
+        self.lscLatency.ClearAll()
+        self.lscLatency.InsertColumn(0, 'Latency', width=70)
+        self.lscLatency.InsertColumn(1, 'p50 ms', width=60)
+        self.lscLatency.InsertColumn(2, 'p99 ms', width=60)
+        for idx, (stage, stats) in enumerate(self.latency.GetStats().items()):
+            self.lscLatency.InsertItem(idx, stage)
+            self.lscLatency.SetItem(idx, 1, '{:.1f}'.format(stats['p50']*1e3))
+            self.lscLatency.SetItem(idx, 2, '{:.1f}'.format(stats['p99']*1e3))
+
+    def OnLatencyTimer(self, evt):
+        if self.IsShownOnScreen():
+            self.ShowLatency()
 
 
     def OnUpdateComData(self, evt):
-        for byte in evt.data:
-            # feed incoming byte to the packet decoder
-            ret = self.pd.AddByte(byte)
-            if ret and ret[0] == RPT_U16XXX:
-                idx = 0
-                lines = []
-                while len(ret) > (idx * 2 + 1):
-                    # convert data into u16 and append it to the value
-                    self.value[idx].append((ret[idx*2+1]<<8) + ret[idx*2+2])
-                    self.value[idx].pop(0)
-                    # create lines
-                    lines.append(wxplot.PolyLine(
-                        list(zip(self.index, self.value[idx])),
-                        colour=self.grpColor[idx], width=2,
-                        style=wx.PENSTYLE_SOLID))
-
-                    # advance index
-                    idx += 1
-
-                # refresh graph
-                if self.grpRun:
-                    graphics = wxplot.PlotGraphics(lines)
-                    self.grpTouch.Draw(graphics)
+        # payloads of the packets decoded by the bus and their receive times
+        payloads = [f[2:-1] for f in evt.frames if not isinstance(f, int)]
+        stamps = [t for f, t in zip(evt.frames, evt.stamps)
+                if not isinstance(f, int)]
+        # decode all the reports at once
+        data = self.rd.DecodeArray(payloads)
+        # no reports, or reports without a channel
+        if len(data) == 0 or data.shape[1] == 0:
+            return
+
+        # channels in the reports
+        channels = data.shape[1]
+        # more channels than before
+        if self.history.channels < data.shape[1]:
+            self.history.SetChannels(data.shape[1])
+            self.decimator.Reset(channels=data.shape[1],
+                    samples=self.history.View(self.history.Count()))
+            # the session so far is kept, zero for the new channels
+            self.pyramid.SetChannels(data.shape[1])
+
+        # new samples in, the oldest ones out (fewer channels: zero)
+        if data.shape[1] < self.history.channels:
+            block = np.zeros((len(data), self.history.channels))
+            block[:,:data.shape[1]] = data
+            data = block
+        self.history.Extend(data)
+        self.decimator.Extend(data)
+        self.pyramid.Extend(data)
+
+        self.channels = channels
+        self.dirty = True
+        if self.grpRun:
+            self.pending.extend(stamps)
+
+    ## Redraw the graph if there is new data since the last frame, or if
+    # the graph is panned or zoomed while paused
+    def OnDrawTimer(self, evt):
+        # refresh graph only when it can be seen
+        if not self.grpRun or not self.IsShownOnScreen():
+            self.pending = []
+        if not self.IsShownOnScreen() or not self.channels:
+            return
+
+        if self.grpRun:
+            if self.dirty:
+                self.DrawGraph()
+        elif self.grpTouch.GetUserRange() != self.lastRange:
+            self.DrawGraph()
+
+    def DrawGraph(self):
+        # nothing to draw yet
+        if not self.channels:
+            return
+
+        # buckets of the envelope follow the width of the canvas
+        width = self.grpTouch.GetPlotWidth()
+        if width > 0 and width != self.decimator.width:
+            self.decimator.Reset(width=width,
+                    samples=self.history.View(self.history.Count()))
+
+        # two points per pixel however long the window is
+        xRange = self.grpTouch.GetUserRange()
+        if xRange is None:
+            self.origin = self.pyramid.Count() - self.history.size
+            x, ys = self.decimator.Get()
+        # range moved with the toolbar: from the whole session
+        else:
+            x, ys = self.pyramid.Envelope(self.origin + xRange[0],
+                    self.origin + xRange[1] + 1, max(width, 1))
+            x -= self.origin
+        self.lastRange = xRange
+        # colours repeat over the eight
+        colours = [self.grpColor[idx % len(self.grpColor)]
+                for idx in range(self.channels)]
+        self.grpTouch.DrawStream(x, ys[:self.channels], colours,
+                xAxis=(0, self.history.size - 1))
+        self.dirty = False
+
+        # from the read to the end of the drawing
+        if self.pending:
+            self.latency.Add('draw', self.pending)
+            self.pending = []
 
 #
 #--------1---------2---------3---------4---------5---------6---------7---------8
@@ -158,20 +287,26 @@ class GraphPanel(wx.Panel):
 #
 class MyFrame(wx.Frame):
 
-    def __init__(self, parent, title):
+    def __init__(self, parent, title, ports=None):
         wx.Frame.__init__(self, parent, title=title)
         frameSize = (900,600)
 
         # notebook panel
         self.pnlBook = wx.Notebook(self)
         # serial terminal panel
-        self.pnlTerm = TermPanel(self.pnlBook, serial.Serial(), size=frameSize)
+        self.pnlTerm = TermPanel(self.pnlBook, serial.Serial(), ports,
+                size=frameSize)
         # plot panel
         self.pnlPlot = GraphPanel(self.pnlBook, size = frameSize)
 
         self.pnlBook.InsertPage(0,self.pnlTerm,'Terminal')
         self.pnlBook.InsertPage(1,self.pnlPlot,'Graph')
 
+        # both pages receive the COM data; the hidden one at a low rate
+        self.pnlTerm.bus.Subscribe(self.pnlPlot, hiddenRate)
+        # latency from the read to the drawing
+        self.pnlPlot.SetLatencyMonitor(self.pnlTerm.latency)
+
         # event handler
         self.pnlBook.Bind(wx.EVT_NOTEBOOK_PAGE_CHANGED, self.OnPageChanged)
         self.Bind(wx.EVT_CLOSE, self.OnClose)
@@ -195,14 +330,23 @@ class MyFrame(wx.Frame):
             return
 
         if self.pnlBook.GetSelection() == 0:
-            self.pnlTerm.thread.SetEventTarget(self.pnlTerm)
+            # text received while on the graph page
+            self.pnlTerm.FlushTerminal()
+            self.pnlTerm.bus.SetRate(self.pnlTerm, shownRate)
+            self.pnlTerm.bus.SetRate(self.pnlPlot, hiddenRate)
 
         elif self.pnlBook.GetSelection() == 1:
-            self.pnlTerm.thread.SetEventTarget(self.pnlPlot)
+            self.pnlTerm.bus.SetRate(self.pnlTerm, hiddenRate)
+            self.pnlTerm.bus.SetRate(self.pnlPlot, shownRate)
 
     def OnClose(self, evt):
         # set the close flag first
         self.close_flag = True
+        self.pnlPlot.tmrLatency.Stop()
+        self.pnlPlot.tmrDraw.Stop()
+        self.pnlPlot.CloseHistory()
+        # the port, the threads and the capture
+        self.pnlTerm.Shutdown()
         # then destroy
         self.Destroy()
 
@@ -211,5 +355,7 @@ class MyFrame(wx.Frame):
 if __name__=="__main__":
     # app loop
     app = wx.App()
-    frame = MyFrame(None, "Touch Sensor Monitor")
+    # extra ports (TSCSim.py for example) from the command line
+    import sys
+    frame = MyFrame(None, "Touch Sensor Monitor", sys.argv[1:])
     app.MainLoop()
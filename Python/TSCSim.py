@@ -0,0 +1,287 @@
+#!/usr/bin/env python3
+
+################################################################################
+#
+#   \file
+#   \author     <a href="http://www.innomatic.ca">innomatic</a>
+#   \brief      Simulator of the stm32tsc firmware on a pseudo terminal
+#   \copyright  <a rel="license" href="http://creativecommons.org/licenses/by-nc/4.0/"><img alt="Creative Commons Licence" style="border-width:0" src="https://i.creativecommons.org/l/by-nc/4.0/88x31.png" /></a><br />This work is licensed under a <a rel="license" href="http://creativecommons.org/licenses/by-nc/4.0/">Creative Commons Attribution-NonCommercial 4.0 International License</a>.
+#
+#   TSCSimulator opens a pseudo terminal and behaves like the board running
+#   Src/main.c on the other end of it, so the host side can be tested (and
+#   loaded far beyond the RTC tick of the firmware) without the hardware.
+#
+#   * TSC_RPTVAL starts (payload 0x01) or stops (0x00) the reports
+#   * every valid packet is answered with ACK, a broken one with NAK
+#   * reports are RPT_U16X01 packets of the touch counts of the channels
+#
+#   The touch counts are a baseline with a linear drift plus gaussian noise.
+#   Faults can be injected into the outgoing stream, each with a probability
+#   per report:
+#
+#   * 'csum': checksum of the packet is corrupted
+#   * 'drop': packet is lost
+#   * 'truncate': packet is cut short
+#   * 'noise': random bytes are inserted after the packet
+#
+#   Posix only (pty module).
+#
+#   \verbatim
+#   python3 TSCSim.py --channels 4 --rate 2000 --noise 5 --fault csum=0.01
+#   python3 TSCMonitor.py /dev/pts/3
+#   \endverbatim
+#
+
+import os
+import pty
+import random
+import select
+import struct
+import threading
+import time
+import tty
+from SerialCom import *
+
+# number of channels fit in one report
+MAX_CHANNELS = (MAX_PAYLOAD - 1) // 2
+
+# fault types
+FaultTypes = ('csum', 'drop', 'truncate', 'noise')
+
+#--------1---------2---------3---------4---------5---------6---------7---------8
+class TSCSimulator():
+
+    def __init__(self, channels=2, rate=10, baseline=1000, noise=0.0,
+            drift=0.0, faults=None, seed=None):
+        # report parameters
+        self.channels = 1
+        self.SetChannels(channels)
+        self.rate = rate
+        self.baseline = baseline
+        self.noise = noise
+        self.drift = drift
+        self.faults = {}
+        self.SetFaults(faults or {})
+        self.rnd = random.Random(seed)
+        # reporting flag (tsc_rpt_flag of the firmware)
+        self.reporting = False
+        # command decoder
+        self.pd = PacketDecoder('FULL')
+        # pseudo terminal
+        self.master = None
+        self.slave = None
+        self.port = None
+        # thread
+        self.worker = None
+        self.keepGoing = False
+        self.ResetStats()
+
+    ## Set the number of channels of the report (1 to MAX_CHANNELS)
+    def SetChannels(self, channels):
+        self.channels = min(max(int(channels), 1), MAX_CHANNELS)
+
+    ## Set the report rate (per second)
+    def SetRate(self, rate):
+        self.rate = rate
+
+    ## Set the fault probabilities, as in {'csum':0.01, 'drop':0.001}
+    def SetFaults(self, faults):
+        for key in faults:
+            if key not in FaultTypes:
+                raise ValueError('unknown fault type: ' + key)
+        self.faults = dict(faults)
+
+    def ResetStats(self):
+        self.commands = 0
+        self.naks = 0
+        self.reports = 0
+        self.injected = dict.fromkeys(FaultTypes, 0)
+        # bytes lost because the other end does not read
+        self.overrun = 0
+        self.start = time.monotonic()
+
+    def GetStats(self):
+        stats = {
+                'commands': self.commands,
+                'naks': self.naks,
+                'reports': self.reports,
+                'overrun': self.overrun,
+                }
+        stats.update(self.injected)
+        return stats
+
+    ## Open the pseudo terminal and return the name of the port to connect
+    def Open(self):
+        self.master, self.slave = pty.openpty()
+        # no echo, no line editing on either side
+        tty.setraw(self.master)
+        tty.setraw(self.slave)
+        # like a UART, the reports are lost when nobody reads them
+        os.set_blocking(self.master, False)
+        self.port = os.ttyname(self.slave)
+        return self.port
+
+    def Close(self):
+        self.Stop()
+        for fd in (self.master, self.slave):
+            if fd is not None:
+                os.close(fd)
+        self.master = self.slave = None
+
+    def Start(self):
+        if self.master is None:
+            self.Open()
+        self.keepGoing = True
+        self.worker = threading.Thread(target=self.Run, name='TSCSimulator',
+                daemon=True)
+        self.worker.start()
+
+    def Stop(self):
+        self.keepGoing = False
+        if self.worker is not None:
+            self.worker.join()
+            self.worker = None
+
+    def IsRunning(self):
+        return self.worker is not None and self.worker.is_alive()
+
+    ## Send bytes to the host; what does not fit is lost
+    def Write(self, data):
+        try:
+            count = os.write(self.master, data)
+        except BlockingIOError:
+            count = 0
+        self.overrun += len(data) - count
+
+    ## Process the bytes from the host
+    def Receive(self, data):
+        errors = self.pd.sizeErrors + self.pd.csumErrors
+        replies = bytearray()
+
+        for packet in self.pd.Feed(data):
+            # ACK/NAK/IAM from the host
+            if isinstance(packet, int):
+                continue
+
+            self.commands += 1
+            replies.append(PKT_ACK)
+            # command byte
+            if packet[1] and packet[2] == TSC_RPTVAL:
+                self.reporting = packet[1] > 1 and packet[3] != 0
+
+        # NAK for each broken packet
+        errors = self.pd.sizeErrors + self.pd.csumErrors - errors
+        self.naks += errors
+        replies.extend(bytes((PKT_NAK,)) * errors)
+
+        if replies:
+            self.Write(bytes(replies))
+
+    ## Return the touch counts of the channels at time t (seconds)
+    def Sample(self, t):
+        values = []
+        for idx in range(self.channels):
+            value = self.baseline + self.drift * t
+            if self.noise:
+                value += self.rnd.gauss(0, self.noise)
+            values.append(min(max(int(value), 0), 0xffff))
+        return values
+
+    ## Return the report packet of the touch counts with the faults injected
+    def MakeReport(self, values):
+        packet = MakePacket(struct.pack('>B{:d}H'.format(len(values)),
+            RPT_U16XXX, *values))
+
+        for fault, prob in self.faults.items():
+            if not prob or self.rnd.random() >= prob:
+                continue
+            self.injected[fault] += 1
+            if fault == 'csum':
+                packet = packet[:-1] + bytes((packet[-1] ^ 0xff,))
+            elif fault == 'drop':
+                return b''
+            elif fault == 'truncate':
+                packet = packet[:self.rnd.randrange(1, len(packet))]
+            elif fault == 'noise':
+                packet += bytes(self.rnd.randrange(256)
+                        for x in range(self.rnd.randint(1, 4)))
+
+        return packet
+
+    ## Thread routine: serve the commands and send the reports on time
+    def Run(self):
+        due = time.monotonic()
+
+        while self.keepGoing:
+            now = time.monotonic()
+            wait = max(min(due - now, 0.1), 0) if self.reporting else 0.1
+            ready, _, _ = select.select([self.master], [], [], wait)
+
+            if ready:
+                try:
+                    data = os.read(self.master, 4096)
+                except (BlockingIOError, OSError):
+                    data = b''
+                if data:
+                    self.Receive(data)
+
+            now = time.monotonic()
+            if not self.reporting or self.rate <= 0:
+                due = now
+                continue
+
+            # all the reports due by now (rate can exceed the loop rate)
+            count = int((now - due) * self.rate) + 1 if now >= due else 0
+            if count:
+                # do not catch up more than a second of reports
+                count = min(count, max(int(self.rate), 1))
+                t = now - self.start
+                self.Write(b''.join(self.MakeReport(self.Sample(t))
+                    for x in range(count)))
+                self.reports += count
+                due = max(due + count / self.rate, now - 1.0)
+
+
+#--------1---------2---------3---------4---------5---------6---------7---------8
+if __name__=='__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(
+            description='stm32tsc firmware simulator on a pseudo terminal')
+    parser.add_argument('--channels', type=int, default=2,
+            help='number of channels (1 to {})'.format(MAX_CHANNELS))
+    parser.add_argument('--rate', type=float, default=10,
+            help='reports per second (default: 10)')
+    parser.add_argument('--baseline', type=int, default=1000,
+            help='touch count without touch (default: 1000)')
+    parser.add_argument('--noise', type=float, default=0.0,
+            help='standard deviation of the touch count')
+    parser.add_argument('--drift', type=float, default=0.0,
+            help='drift of the touch count per second')
+    parser.add_argument('--fault', action='append', default=[],
+            help='fault injection as type=probability, type is one of ' +
+            ', '.join(FaultTypes))
+    parser.add_argument('--report', action='store_true',
+            help='start reporting without TSC_RPTVAL command')
+    args = parser.parse_args()
+
+    faults = {}
+    for item in args.fault:
+        key, _, value = item.partition('=')
+        faults[key] = float(value or 1.0)
+
+    sim = TSCSimulator(args.channels, args.rate, args.baseline, args.noise,
+            args.drift, faults)
+    print('simulator on', sim.Open())
+    sim.reporting = args.report
+    sim.Start()
+
+    # statistics every second
+    try:
+        while True:
+            time.sleep(1)
+            print(sim.GetStats())
+    except KeyboardInterrupt:
+        pass
+
+    sim.Close()
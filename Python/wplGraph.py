@@ -7,7 +7,23 @@
 #   \brief      Wxplot example
 #   \copyright  <a rel="license" href="http://creativecommons.org/licenses/by-nc/4.0/"><img alt="Creative Commons Licence" style="border-width:0" src="https://i.creativecommons.org/l/by-nc/4.0/88x31.png" /></a><br />This work is licensed under a <a rel="license" href="http://creativecommons.org/licenses/by-nc/4.0/">Creative Commons Attribution-NonCommercial 4.0 International License</a>.
 #
+#   Besides Draw() of wxplot graphics, WplGraph has a streaming mode for
+#   data updated many times a second. DrawStream() has the canvas draw the
+#   axes into a bitmap of its own, and paints only the lines over it,
+#   straight from the NumPy arrays, into the buffer of the canvas. The axes
+#   are drawn again only when the data leaves them, the canvas is resized
+#   or the axes are moved with the toolbar.
+#
+#   Only the public API of PlotCanvas is used, except for the buffer it
+#   paints the window from (_CanvasBuffer()). Where that is not found the
+#   whole graph is drawn by PlotCanvas.Draw() instead, more slowly.
+#
+#   @code
+#   graph.DrawStream(x, ys, ['red', 'blue'])    # ys: (n_lines, len(x))
+#   @endcode
+#
 
+import numpy as np
 import wx
 from wx.lib import plot as wxplot
 from wx.lib.embeddedimage import PyEmbeddedImage
@@ -104,15 +120,39 @@ class WplGraph(wx.Panel):
         # do not call this as a child
         #sizer_h.Fit(self)
 
+        # streaming mode: x, ys, colours and width of the lines
+        self.stream = None
+        # fixed range of the x axis
+        self.xAxis = None
+        # axes follow the data (until moved by the toolbar)
+        self.follow = True
+        # cached axes, their bitmap and the plot area on it
+        self.axes = None
+        self.background = None
+        self.plotBox = None
+        # scale and shift from the axes to the screen
+        self.scale = (1.0, 1.0)
+        self.shift = (0.0, 0.0)
+        # screen coordinates of the points and the pens
+        self.points = np.empty((0, 2), np.int32)
+        self.pens = {}
+
     ## handles mouse click on toolbar
     def OnToolClick(self, evt):
         tid = evt.GetId()
 
         if tid == self.tidHome:
-            self.canvas.Reset()
+            if self.stream is not None:
+                # back to the axes following the data
+                self.follow = True
+                self._Rebuild()
+                self._DrawData()
+            else:
+                self.canvas.Reset()
 
         elif tid == self.tidDrag:
             if self.toolbar.GetToolState(self.tidDrag):
+                self._Sync()
                 self.canvas.enableDrag = True
                 self.toolbar.EnableTool(self.tidHome, False)
                 self.toolbar.EnableTool(self.tidZoom, False)
@@ -125,6 +165,7 @@ class WplGraph(wx.Panel):
 
         elif tid == self.tidZoom:
             if self.toolbar.GetToolState(self.tidZoom):
+                self._Sync()
                 self.canvas.enableZoom = True
                 self.toolbar.EnableTool(self.tidHome, False)
                 self.toolbar.EnableTool(self.tidDrag, False)
@@ -149,23 +190,216 @@ class WplGraph(wx.Panel):
     def GetCanvas(self):
         return self.canvas
 
+    ## return the width of the canvas in pixels
+    def GetPlotWidth(self):
+        return self.canvas.GetClientSize().width
+
+    ## return the x range set with the toolbar in the streaming mode, None
+    # while the axes follow the data
+    def GetUserRange(self):
+        if self.stream is None or self.axes is None:
+            return None
+        current = self._CurrentAxes()
+        if self.follow and self._SameAxes(current, self.axes):
+            return None
+        return current[0]
+
     ## plot wxplot.Graphics object
     def Draw(self, graphics):
+        self.StopStream()
         self.canvas.Draw(graphics)
 
+    ## leave the streaming mode
+    def StopStream(self):
+        self.stream = None
+        self.follow = True
+        self.axes = None
+        self.background = None
+
+    ## plot lines of ys (n_lines, len(x)) against x in the streaming mode.
+    # The x axis follows x unless its range is given.
+    def DrawStream(self, x, ys, colours, width=2, xAxis=None):
+        self.stream = (np.asarray(x), np.asarray(ys), list(colours), width)
+        self.xAxis = xAxis
+
+        # axes moved by the toolbar since the last frame
+        if self.axes is not None and not self._SameAxes(self._CurrentAxes(),
+                self.axes):
+            self.follow = False
+            self.background = None
+
+        # pan or zoom on: the canvas needs its own graphics to work on
+        if self.canvas.enableDrag or self.canvas.enableZoom:
+            self._Sync()
+            return
+
+        # the buffer of the canvas is not known: the canvas draws it all
+        if self._CanvasBuffer() is None:
+            self._Sync(self._StreamAxes())
+            return
+
+        if (self.background is None or self._AxesChanged() or
+                self.background.GetSize() != self._CanvasBuffer()[1].GetSize()):
+            self._Rebuild()
+        self._DrawData()
+
+    ## return the window of the canvas and the bitmap it is painted from,
+    # or None if not found. These are private members of PlotCanvas, the
+    # only ones used here.
+    def _CanvasBuffer(self):
+        window = getattr(self.canvas, 'canvas', None)
+        buffer = getattr(self.canvas, '_Buffer', None)
+        if window is None or buffer is None or not hasattr(buffer, 'GetSize'):
+            return None
+        return window, buffer
+
+    ## return the x and y ranges shown by the canvas
+    def _CurrentAxes(self):
+        return (tuple(map(float, self.canvas.GetXCurrentRange())),
+                tuple(map(float, self.canvas.GetYCurrentRange())))
+
+    def _SameAxes(self, a, b):
+        return np.allclose(np.array(a, np.float64), np.array(b, np.float64))
+
+    ## return the axes for the stream data
+    def _StreamAxes(self):
+        if not self.follow:
+            return self._CurrentAxes()
+
+        x, ys = self.stream[:2]
+        if self.xAxis is not None:
+            xAxis = tuple(map(float, self.xAxis))
+        elif len(x):
+            xAxis = (float(x[0]), float(x[-1]))
+        else:
+            xAxis = (0.0, 1.0)
+        if xAxis[0] == xAxis[1]:
+            xAxis = (xAxis[0], xAxis[0] + 1)
+        if ys.size:
+            low, high = float(ys.min()), float(ys.max())
+        else:
+            low, high = 0.0, 1.0
+        # margin so that small changes stay within the axes
+        margin = max(high - low, 1.0) * 0.1
+        return xAxis, (low - margin, high + margin)
+
+    ## True if the stream data needs new axes
+    def _AxesChanged(self):
+        if not self.follow:
+            return False
+
+        xAxis, yAxis = self.axes
+        x, ys = self.stream[:2]
+        if self.xAxis is not None:
+            if not self._SameAxes(self.xAxis, xAxis):
+                return True
+        elif len(x) and (x[0] != xAxis[0] or x[-1] != xAxis[1]):
+            return True
+        if ys.size:
+            low, high = ys.min(), ys.max()
+            # out of the axes, or using less than a quarter of them
+            if low < yAxis[0] or high > yAxis[1]:
+                return True
+            if max(high - low, 1.0) * 4 < yAxis[1] - yAxis[0]:
+                return True
+        return False
+
+    ## return the wxplot graphics of the stream data
+    def _Graphics(self):
+        x, ys, colours, width = self.stream
+        lines = [wxplot.PolyLine(np.column_stack((x, y)), colour=colour,
+            width=width, style=wx.PENSTYLE_SOLID)
+            for y, colour in zip(ys, colours)]
+        return wxplot.PlotGraphics(lines)
+
+    ## draw the stream data by the canvas on the axes given (those shown by
+    # default), so that the canvas tools work on the latest data
+    def _Sync(self, axes=None):
+        if self.stream is None:
+            return
+        if axes is None:
+            axes = self._CurrentAxes()
+        self.canvas.Draw(self._Graphics(), *axes)
+        self.axes = self._CurrentAxes()
+        self.background = None
+
+    ## draw the axes by the canvas into a bitmap kept as the background
+    def _Rebuild(self):
+        xAxis, yAxis = self._StreamAxes()
+        # invisible line to have the axes drawn without the data
+        blank = wxplot.PolyLine(np.array([[xAxis[0], yAxis[0]],
+            [xAxis[1], yAxis[1]]]), style=wx.PENSTYLE_TRANSPARENT)
+
+        width, height = self._CanvasBuffer()[1].GetSize()
+        self.background = wx.Bitmap(max(width, 1), max(height, 1))
+        dc = wx.MemoryDC(self.background)
+        dc.SetBackground(wx.Brush(self.canvas.GetBackgroundColour()))
+        dc.Clear()
+        self.canvas.Draw(wxplot.PlotGraphics([blank]), xAxis, yAxis, dc)
+        dc.SelectObject(wx.NullBitmap)
+
+        # the axes are linear: two points give the scale and the shift
+        x0, y0 = self.canvas.PositionUserToScreen((0.0, 0.0))
+        x1, y1 = self.canvas.PositionUserToScreen((1.0, 1.0))
+        self.scale = (float(x1 - x0), float(y1 - y0))
+        self.shift = (float(x0), float(y0))
+
+        # plot area on the screen
+        x0, y0 = self._ToScreen(xAxis[0], yAxis[1])
+        x1, y1 = self._ToScreen(xAxis[1], yAxis[0])
+        self.plotBox = (int(x0), int(y0), int(x1 - x0) + 1, int(y1 - y0) + 1)
+        self.axes = self._CurrentAxes()
+
+    def _ToScreen(self, x, y):
+        return (x * self.scale[0] + self.shift[0],
+                y * self.scale[1] + self.shift[1])
+
+    def _Pen(self, colour, width):
+        key = (str(colour), width)
+        if key not in self.pens:
+            self.pens[key] = wx.Pen(colour, width, wx.PENSTYLE_SOLID)
+        return self.pens[key]
+
+    ## paint the lines over the background, double buffered
+    def _DrawData(self):
+        x, ys, colours, width = self.stream
+        if len(self.points) != len(x):
+            self.points = np.empty((len(x), 2), np.int32)
+        # far out of the screen (zoomed in) still fits into int32
+        limit = 1 << 20
+        sx, sy = self._ToScreen(x, 0)
+        self.points[:,0] = np.clip(sx, -limit, limit)
+
+        window, buffer = self._CanvasBuffer()
+        dc = wx.BufferedDC(wx.ClientDC(window), buffer)
+        dc.DrawBitmap(self.background, 0, 0)
+        dc.SetClippingRegion(*self.plotBox)
+        for y, colour in zip(ys, colours):
+            sx, sy = self._ToScreen(0, y)
+            self.points[:,1] = np.clip(sy, -limit, limit)
+            dc.SetPen(self._Pen(colour, width))
+            if hasattr(dc, 'DrawLinesFromBuffer'):
+                dc.DrawLinesFromBuffer(self.points)
+            else:
+                dc.DrawLines(self.points)
+        dc.DestroyClippingRegion()
+        # blit to the screen
+        del dc
+
     ## set canvas axes pen
     def SetPen(self, pen):
         self.canvas.axesPen = pen
 
     ## clear canvas
     def Clear(self):
+        self.StopStream()
         self.canvas.Clear()
 
 
 #--------1---------2---------3---------4---------5---------6---------7---------8
 if __name__=="__main__":
 
-    import numpy as np
+    import time
 
     class MyFrame(wx.Frame):
 
@@ -175,11 +409,13 @@ if __name__=="__main__":
             # menu id
             self.idLine = wx.NewId()
             self.idHist= wx.NewId()
+            self.idStream = wx.NewId()
             # menu
             menu = wx.Menu()
             # menu item
             mitemLine = menu.Append(self.idLine, "Line", "")
             mitemHist = menu.Append(self.idHist, "Histogram", "")
+            mitemStream = menu.Append(self.idStream, "Stream", "")
 
             # menubar
             menubar = wx.MenuBar()
@@ -192,6 +428,7 @@ if __name__=="__main__":
             # event binding
             self.Bind(wx.EVT_MENU, self.OnDrawGraph, mitemLine)
             self.Bind(wx.EVT_MENU, self.OnDrawGraph, mitemHist)
+            self.Bind(wx.EVT_MENU, self.OnDrawGraph, mitemStream)
             self.Bind(wx.EVT_CLOSE, self.OnClose)
 
             # sizer
@@ -203,8 +440,17 @@ if __name__=="__main__":
             self.sizer.Fit(self)
             self.Show()
 
+            # streaming demo: 8 lines of 10k points as fast as possible
+            self.tmrStream = wx.Timer(self)
+            self.Bind(wx.EVT_TIMER, self.OnStreamTimer, self.tmrStream)
+            self.x = np.arange(10000)
+            self.phase = 0
+            self.frames = 0
+            self.start = 0
+
 
         def OnDrawGraph(self, evt):
+            self.tmrStream.Stop()
 
             # simple line plot
             if evt.GetId() == self.idLine:
@@ -246,7 +492,31 @@ if __name__=="__main__":
                         'value', 'count')
                 self.pnlPlot.Draw(graphics)
 
+            # streaming mode
+            elif evt.GetId() == self.idStream:
+                self.pnlPlot.Clear()
+                self.frames = 0
+                self.start = time.perf_counter()
+                self.tmrStream.Start(1)
+
+        def OnStreamTimer(self, evt):
+            self.phase += 50
+            ys = [np.sin((self.x + self.phase) / (500 + 100 * idx)) + idx
+                    for idx in range(8)]
+            colours = ['red', 'blue', 'green', 'orange', 'purple', 'brown',
+                    'navy', 'magenta']
+            self.pnlPlot.DrawStream(self.x, np.array(ys), colours, 1)
+
+            self.frames += 1
+            elapsed = time.perf_counter() - self.start
+            if elapsed > 1:
+                self.SetTitle('WplGraph demo: {:.1f} fps'.format(
+                    self.frames / elapsed))
+                self.frames = 0
+                self.start = time.perf_counter()
+
         def OnClose(self, evt):
+            self.tmrStream.Stop()
             # explicitly destroy the panel
             self.pnlPlot.Close()
             # destroy self
@@ -8,19 +8,28 @@
 #   \copyright  <a rel="license" href="http://creativecommons.org/licenses/by-nc/4.0/"><img alt="Creative Commons Licence" style="border-width:0" src="https://i.creativecommons.org/l/by-nc/4.0/88x31.png" /></a><br />This work is licensed under a <a rel="license" href="http://creativecommons.org/licenses/by-nc/4.0/">Creative Commons Attribution-NonCommercial 4.0 International License</a>.
 #
 
+import collections
 import os
 import pickle
 import serial
-import _thread
+import threading
+import time
 import wx
 import wx.lib.newevent
 from SerialCom import *
+from ByteQueue import ByteQueue
+from CmdChannel import CommandChannel
+from Capture import IndexedCaptureWriter
+from Latency import LatencyMonitor
 
 # new event class for the COM thread
 (UpdateComData, EVT_UPDATE_COMDATA) = wx.lib.newevent.NewEvent()
 
-# default data file name
+# default directory of the data files, and their base name
+data_dir = os.path.join(os.path.expanduser('~'), 'wxpyterm')
 data_file = 'wxpyterm.dat'
+# compression of the data files (None, 'gzip', 'bz2' or 'lzma')
+data_compress = None
 
 ## Return (default) monospace font face name depending on the OS.
 #
@@ -43,6 +52,44 @@ def GetMonoFont():
     else:
         return None
 
+## Return the hex display text of the data and the new column counter.
+# Each byte is shown as 0xXX followed by '.', or by ' - ' in the middle and
+# a newline at the end of a 16 byte line. The counter is the number of
+# bytes already in the current line.
+#
+def HexText(data, counter=0):
+    text = []
+    pos = 0
+
+    # half a line at a time
+    while pos < len(data):
+        count = min(8 - counter % 8, len(data) - pos)
+        part = data[pos:pos + count].hex('.').upper()
+        text.append('0x' + part.replace('.', '.0x'))
+        pos += count
+        counter += count
+
+        if counter == 8:
+            text.append(' - ')
+        elif counter == 16:
+            text.append('\n')
+            counter = 0
+        else:
+            text.append('.')
+
+    return ''.join(text), counter
+
+## Return the ASCII display text of the data. The newline byte (0x0A or 0x0D)
+# starts a new line and the other one of the pair is ignored.
+#
+def AsciiText(data, newLine=0x0A):
+    if newLine == 0x0D:
+        data = data.replace(b'\n', b'').replace(b'\r', b'\n')
+    else:
+        data = data.replace(b'\r', b'')
+    # one character per byte
+    return data.decode('latin-1')
+
 #--------1---------2---------3---------4---------5---------6---------7---------8
 ##
 # \brief    COM port listening thread.
@@ -50,67 +97,487 @@ def GetMonoFont():
 #           stops before the port is closed. Also the timeout value of
 #           the port should be set preferably with small value.
 #
+#           Received data is put into a bounded queue instead of being
+#           posted chunk by chunk. ComBus takes it out of the queue and
+#           delivers it to the windows.
+#
+#           With decoding enabled (default), the thread also runs the packet
+#           decoder on each chunk and keeps the decoded packets for the
+#           ComBus, so that the GUI thread does no decoding at all. The
+#           ACK/NAK/IAM bytes found there are also given to the reply handler
+#           right away, for the CommandChannel. The chunk and its packets are
+#           queued under one lock and TakeAll() takes both out under the same
+#           lock, so the raw data and the packets handed out always match.
+#
+#           Each chunk is stamped with the time its first byte was read
+#           (time.monotonic_ns()) and handed to the capture function, if
+#           any, with the stamp. The decoded packets keep the stamp of
+#           their chunk, and the time taken to decode them is added to the
+#           'decode' latency.
+#
 class ComThread:
 
-    def __init__(self, win, ser):
+    def __init__(self, win, ser, maxChunk=4096, maxLatency=0.01,
+            queueSize=1<<20, policy='DROP', decode=True, maxFrames=100000,
+            latency=None):
         # window to which the receiving data is sent
         self.win = win
         # serial port
         self.ser = ser
-        # initial state
-        self.running = False
+        # worker thread
+        self.worker = None
+        # read parameters
+        self.SetReadParams(maxChunk, maxLatency)
+        # received data waiting for the delivery
+        self.queue = ByteQueue(queueSize, policy)
+        # decoded packets waiting for the delivery and their receive times
+        self.frames = []
+        self.stamps = []
+        self.maxFrames = maxFrames
+        self.framesDropped = 0
+        self.lock = threading.Lock()
+        # function called with each reply byte
+        self.replyHandler = None
+        # function called with each chunk and its receive time
+        self.capture = None
+        self.stamp = 0
+        # latency histograms
+        self.latency = latency if latency is not None else LatencyMonitor()
+        # packet decoder
+        self.SetDecoding(decode)
 
     ## call this method to start the thread.
     def Start(self):
         self.keepGoing = True
-        self.running = True
-        _thread.start_new_thread(self.Run, ())
+        self.worker = threading.Thread(target=self.Run, name='ComThread',
+                daemon=True)
+        self.worker.start()
 
     ## signal the thread to suicide
     def Stop(self):
         # flag for nice termination
         self.keepGoing = False
+        # interrupt the blocked read
+        try:
+            self.ser.cancel_read()
+        except Exception:
+            pass
+
+    ## wait for the thread to terminate
+    def Join(self, timeout=None):
+        if self.worker is not None:
+            self.worker.join(timeout)
 
-    ## main routine: upon arrival of new data, it generates an event.
+    ## stop the thread and close the port
+    def Close(self):
+        if self.IsRunning():
+            self.Stop()
+            self.Join()
+
+        if self.ser.is_open:
+            self.ser.close()
+
+    ## (re)open the port with the given settings and start the thread.
+    # Returns True on success.
+    def Open(self, port, speed, timeout=1):
+        self.Close()
+
+        # set port number and speed
+        self.ser.port = port
+        self.ser.baudrate = int(speed)
+        # read is interrupted by Stop(), the timeout is a fallback only
+        self.ser.timeout = timeout
+
+        # open the serial port
+        try:
+            self.ser.open()
+        except:
+            return False
+
+        # data of the previous port is not continued
+        with self.lock:
+            self.queue.Clear()
+            self.frames = []
+            self.stamps = []
+        self.SetDecoding(self.IsDecoding())
+
+        # start thread
+        self.Start()
+        return True
+
+    ## set the maximum size of a chunk and the maximum time (in seconds) to
+    # collect the following bytes once the first byte has arrived
+    def SetReadParams(self, maxChunk=None, maxLatency=None):
+        if maxChunk is not None and maxChunk > 0:
+            self.maxChunk = maxChunk
+        if maxLatency is not None and maxLatency >= 0:
+            self.maxLatency = maxLatency
+
+    ## run the packet decoder ('FULL' mode) on this thread or not
+    def SetDecoding(self, flag):
+        if flag:
+            self.pd = PacketDecoder('FULL', resync=True)
+        else:
+            self.pd = None
+
+    ## return True if the packets are decoded on this thread
+    def IsDecoding(self):
+        return self.pd is not None
+
+    ## set the function called on this thread with each ACK/NAK/IAM byte
+    # (decoding only)
+    def SetReplyHandler(self, handler):
+        self.replyHandler = handler
+
+    ## set the function called on this thread with each chunk of data read
+    # and its receive time, as capture(data, stamp)
+    def SetCapture(self, capture):
+        self.capture = capture
+
+    ## take out all the received data, the packets decoded from it and their
+    # receive times, as (data, frames, stamps)
+    def TakeAll(self):
+        with self.lock:
+            data = self.queue.Get()
+            frames, self.frames = self.frames, []
+            stamps, self.stamps = self.stamps, []
+        return data, frames, stamps
+
+    ## read a chunk of data: wait for the first byte until timeout, then take
+    # whatever arrives within the maximum latency from the first byte, up to
+    # the maximum size. No read asks for more than the room left.
+    def ReadChunk(self):
+        # block for the first byte
+        data = self.ser.read(1)
+        if not data:
+            return data
+
+        # receive time of the chunk, from which the latency runs
+        self.stamp = time.monotonic_ns()
+        deadline = self.stamp * 1e-9 + self.maxLatency
+        while len(data) < self.maxChunk:
+            # available bytes, as many as fit
+            waiting = min(self.ser.in_waiting, self.maxChunk - len(data))
+            if waiting:
+                data += self.ser.read(waiting)
+            # out of time, even if the bytes keep coming
+            left = deadline - time.monotonic()
+            if left <= 0:
+                break
+            # wait for more
+            if not waiting:
+                time.sleep(min(0.001, left))
+
+        return data
+
+    ## main routine: upon arrival of new data, it puts them into the queue.
     def Run(self):
         # keep running as far as the flag is set
         while self.keepGoing:
             # read data until timeout
-            data = self.ser.read(10)
+            try:
+                data = self.ReadChunk()
+            except serial.SerialException:
+                # port is gone
+                break
             # valid byte received
             if len(data):
-                # create an event with the byte
-                evt = UpdateComData(data = data)
-                # post the event
-                wx.PostEvent(self.win, evt)
-
-        # end of loop
-        self.running = False
+                # raw data to the disk
+                capture = self.capture
+                if capture is not None:
+                    capture(data, self.stamp)
+
+                # decode the chunk
+                pd = self.pd
+                frames = pd.Feed(data) if pd is not None else []
+                if frames:
+                    self.latency.Add('decode', [self.stamp] * len(frames))
+                    # replies to the commands
+                    handler = self.replyHandler
+                    if handler is not None:
+                        for frame in frames:
+                            if isinstance(frame, int):
+                                handler(frame)
+
+                # blocking put gives up after the port timeout. The room is
+                # waited for without the lock, so TakeAll() can make it.
+                if self.queue.policy == 'BLOCK':
+                    self.queue.WaitRoom(len(data), self.ser.timeout)
+
+                # data and its packets go in together
+                with self.lock:
+                    self.queue.Put(data, 0)
+                    self.frames += frames
+                    self.stamps += [self.stamp] * len(frames)
+                    # drop the oldest
+                    over = len(self.frames) - self.maxFrames
+                    if over > 0:
+                        del self.frames[:over]
+                        del self.stamps[:over]
+                        self.framesDropped += over
+
+    ## return the number of bytes dropped by queue overflow
+    def GetDropped(self):
+        return self.queue.dropped
 
     ## return True if the thread is running
     def IsRunning(self):
-        return self.running
+        return self.worker is not None and self.worker.is_alive()
 
     ## change the target window for the event
     def SetEventTarget(self, win):
         self.win = win
 
+#--------1---------2---------3---------4---------5---------6---------7---------8
+##
+# \brief    Serial port writer thread
+# \details  Data to be sent is put into a bounded queue and written to the
+#           port by this thread, so the GUI never waits for the port. Data
+#           put within the coalescing time after the first byte is written
+#           at once (up to the maximum chunk size), which turns a burst of
+#           keystrokes or small packets into a single write. Data that does
+#           not fit in the queue, or arrives while the port is closed, is
+#           dropped and counted.
+#
+class ComWriter:
+
+    def __init__(self, ser, queueSize=1<<16, maxChunk=4096, coalesce=0.002):
+        # serial port
+        self.ser = ser
+        # outbound data
+        self.queue = ByteQueue(queueSize, 'BLOCK')
+        # coalescing parameters
+        self.maxChunk = maxChunk
+        self.coalesce = coalesce
+        # (time, total bytes put) of each put, for the latency
+        self.marks = collections.deque()
+        self.lock = threading.Lock()
+        # bytes taken out of the queue and being written
+        self.inflight = 0
+        # worker thread
+        self.worker = None
+        self.keepGoing = False
+        self.ResetStats()
+
+    def ResetStats(self):
+        self.put = 0
+        self.written = 0
+        self.writes = 0
+        self.dropped = 0
+        # time from put to the end of the write (seconds)
+        self.latency = 0.0
+        self.maxLatency = 0.0
+        self.sumLatency = 0.0
+        self.latencyCount = 0
+
+    ## return the statistics: queue depth (bytes), byte and write counts,
+    # and the write latency (seconds)
+    def GetStats(self):
+        return {
+                'depth': self.queue.Count(),
+                'put': self.put,
+                'written': self.written,
+                'writes': self.writes,
+                'dropped': self.dropped + self.queue.dropped,
+                'latency': self.latency,
+                'maxLatency': self.maxLatency,
+                'meanLatency': self.sumLatency / self.latencyCount
+                    if self.latencyCount else 0.0,
+                }
+
+    def Start(self):
+        self.keepGoing = True
+        self.worker = threading.Thread(target=self.Run, name='ComWriter',
+                daemon=True)
+        self.worker.start()
+
+    def Stop(self):
+        self.keepGoing = False
+        # interrupt the blocked write
+        try:
+            self.ser.cancel_write()
+        except Exception:
+            pass
+        if self.worker is not None:
+            self.worker.join()
+            self.worker = None
+
+    ## queue the data; never blocks. Returns the number of bytes queued.
+    def Put(self, data):
+        with self.lock:
+            count = self.queue.Put(data, 0)
+            self.put += count
+            self.marks.append((time.monotonic(), self.put))
+        return count
+
+    ## throw away the data not written yet. The write in progress, if any,
+    # is still counted when it ends.
+    def Clear(self):
+        with self.lock:
+            self.dropped += self.queue.Count()
+            self.queue.Clear()
+            self.written = self.put - self.inflight
+            self.marks.clear()
+
+    ## main routine: write the queued data
+    def Run(self):
+        while self.keepGoing:
+            if not self.queue.Wait(1, 0.1):
+                continue
+
+            # let small writes pile up a little
+            if self.coalesce > 0 and self.queue.Count() < self.maxChunk:
+                self.queue.Wait(self.maxChunk, self.coalesce)
+
+            with self.lock:
+                data = self.queue.Get()
+                self.inflight = len(data)
+            try:
+                if not self.ser.is_open:
+                    raise serial.SerialException('port is not open')
+                self.ser.write(data)
+                failed = False
+            except (serial.SerialException, OSError, ValueError):
+                failed = True
+
+            # latency of the puts completed by this write
+            now = time.monotonic()
+            with self.lock:
+                if failed:
+                    self.dropped += len(data)
+                else:
+                    self.writes += 1
+                self.written += len(data)
+                self.inflight = 0
+                while self.marks and self.marks[0][1] <= self.written:
+                    self.latency = now - self.marks.popleft()[0]
+                    self.maxLatency = max(self.maxLatency, self.latency)
+                    self.sumLatency += self.latency
+                    self.latencyCount += 1
+
+#--------1---------2---------3---------4---------5---------6---------7---------8
+## subscriber of the ComBus
+class ComSubscriber:
+
+    def __init__(self, win, rate):
+        # window to which the data is sent
+        self.win = win
+        # delivery rate (per second)
+        self.rate = rate
+        # data and packets waiting for the delivery
+        self.data = bytearray()
+        self.frames = []
+        self.stamps = []
+        # time of the last delivery
+        self.last = 0.0
+
+##
+# \brief    Fan-out of the COM data to the windows
+# \details  The bus takes the received data and the packets decoded by the
+#           COM thread out of it at once and sends both the raw data
+#           (evt.data) and the decoded packets (evt.frames, see PacketDecoder
+#           'FULL' mode) with their receive times in monotonic ns
+#           (evt.stamps) to every subscribed window with an UpdateComData
+#           event. Without decoding on the COM thread, evt.frames is empty.
+#           Each subscriber has its own delivery rate and the data arriving
+#           in between is accumulated, so a hidden window can be given a
+#           low rate instead of being cut off.
+#
+class ComBus(wx.EvtHandler):
+
+    def __init__(self, thread, rate=60):
+        wx.EvtHandler.__init__(self)
+
+        # COM thread
+        self.thread = thread
+        # list of ComSubscriber
+        self.subs = []
+        # polling rate (per second)
+        self.rate = rate
+
+        # polling timer
+        self.timer = wx.Timer(self)
+        self.Bind(wx.EVT_TIMER, self.OnTimer, self.timer)
+
+    ## add a window to the subscriber list
+    def Subscribe(self, win, rate=30):
+        self.Unsubscribe(win)
+        self.subs.append(ComSubscriber(win, rate))
+
+    ## remove a window from the subscriber list
+    def Unsubscribe(self, win):
+        self.subs = [sub for sub in self.subs if sub.win is not win]
+
+    ## change the delivery rate of a subscriber
+    def SetRate(self, win, rate):
+        for sub in self.subs:
+            if sub.win is win and rate > 0:
+                sub.rate = rate
+
+    ## forget the data not delivered yet, e.g. when the port is (re)opened
+    def Reset(self):
+        for sub in self.subs:
+            sub.data = bytearray()
+            sub.frames = []
+            sub.stamps = []
+
+    ## start polling
+    def Start(self):
+        self.timer.Start(int(1000 / self.rate))
+
+    ## stop polling
+    def Stop(self):
+        self.timer.Stop()
+
+    ## take the data out of the queue and deliver it to the subscribers
+    def Poll(self):
+        # raw data and the packets decoded from it on the COM thread
+        data, frames, stamps = self.thread.TakeAll()
+
+        if len(data) or frames:
+            for sub in self.subs:
+                sub.data += data
+                sub.frames += frames
+                sub.stamps += stamps
+
+        now = time.monotonic()
+        for sub in list(self.subs):
+            # nothing to deliver or too early
+            if not sub.data and not sub.frames:
+                continue
+            if now - sub.last < 1.0 / sub.rate:
+                continue
+
+            # create an event with the data
+            evt = UpdateComData(data = bytes(sub.data), frames = sub.frames,
+                    stamps = sub.stamps)
+            sub.data = bytearray()
+            sub.frames = []
+            sub.stamps = []
+            sub.last = now
+            # the packets reach the window now, after waiting for its rate
+            if evt.frames:
+                self.thread.latency.Add('deliver', evt.stamps)
+            # process the event
+            sub.win.GetEventHandler().ProcessEvent(evt)
+
+    ## polling timer handler
+    def OnTimer(self, evt):
+        self.Poll()
+
 #--------1---------2---------3---------4---------5---------6---------7---------8
 ##
 # \brief    COM terminal window panel
 #
 class TermPanel(wx.Panel):
 
-    def __init__(self, parent, ser, **kwgs):
+    def __init__(self, parent, ser, ports=None, scrollback=5000, acked=False,
+            dataDir=None, compress=data_compress, **kwgs):
         wx.Panel.__init__(self, parent, **kwgs)
 
         # serial port
         self.ser = ser
 
-        # packet decoder
-        self.pd = PacketDecoder()
-        self.pd.SetMode('decode')
-
         # terminal
         self.txtTerm = wx.TextCtrl(self, wx.ID_ANY, "", size=(700,250),
                 style = wx.TE_MULTILINE|wx.TE_READONLY);
@@ -128,6 +595,8 @@ class TermPanel(wx.Panel):
         # list of available COM ports
         from serial.tools import list_ports
         portlist = [port for port,desc,hwin in list_ports.comports()]
+        # ports not listed by the system, such as pseudo terminals
+        portlist += [port for port in ports or [] if port not in portlist]
 
         # baudrate selection
         self.sttSpeed = wx.StaticText(self.pnlControl, -1, "Baudrate")
@@ -174,8 +643,27 @@ class TermPanel(wx.Panel):
         self.choSndPkt = wx.Choice(self.pnlControl, -1,
                 choices=[key for key in OutPackets.keys()])
 
-        # COM thread object
-        self.thread = ComThread(self, self.ser)
+        # latency histograms of the receive path
+        self.latency = LatencyMonitor()
+
+        # COM thread object, which decodes the packets as well
+        self.thread = ComThread(self, self.ser, latency=self.latency)
+
+        # delivery of the received data
+        self.bus = ComBus(self.thread)
+        self.bus.Subscribe(self)
+
+        # port writer
+        self.writer = ComWriter(self.ser)
+        self.writer.Start()
+
+        # outstanding commands matched with the replies on the COM thread.
+        # The packets of the choice go through it only if the device is
+        # known to reply (acked), otherwise they are simply written.
+        self.acked = acked
+        self.cmd = CommandChannel(self.SendData)
+        self.thread.SetReplyHandler(self.cmd.OnReply)
+        self.cmd.Start()
 
         # sizer
         sizer_g = wx.FlexGridSizer(10,2,4,4)
@@ -223,8 +711,17 @@ class TermPanel(wx.Panel):
         self.Bind(wx.EVT_CLOSE, self.OnClose)
         self.Bind(EVT_UPDATE_COMDATA, self.OnUpdateComData)
 
-        # raw data storage
-        self.rawdata = bytearray()
+        # raw data storage on the disk, written by the COM thread. The
+        # working file is named after the session, so that the one left by
+        # a crash is not overwritten by the next session.
+        self.dataDir = dataDir or data_dir
+        os.makedirs(self.dataDir, exist_ok=True)
+        root, ext = os.path.splitext(data_file)
+        self.capture = IndexedCaptureWriter(os.path.join(self.dataDir,
+            root + time.strftime('-session-%Y%m%d-%H%M%S') + ext),
+            compress=compress)
+        self.capture.Start()
+        self.thread.SetCapture(self.capture.Write)
 
         # event list
         self.lstEvent = None
@@ -247,9 +744,86 @@ class TermPanel(wx.Panel):
         # counter for alignment of hex display
         self.binCounter = 0
 
+        # maximum and current number of lines in the terminal
+        self.scrollback = scrollback
+        self.lineCount = 0
+        # text received while the panel is hidden and its number of lines
+        self.hidden = []
+        self.hiddenLines = 0
+        self.Bind(wx.EVT_SHOW, self.OnShow)
+
     ## Clear terminal. Note that the raw data is not affected.
     def ClearTerminal(self):
         self.txtTerm.Clear()
+        self.lineCount = 0
+        self.hidden = []
+        self.hiddenLines = 0
+
+    ## Set the maximum number of lines kept in the terminal (0: no limit)
+    def SetScrollback(self, lines):
+        self.scrollback = max(int(lines), 0)
+        self.TrimTerminal(True)
+
+    ## Append text to the terminal. While the panel is not shown, the text
+    # is kept aside, up to the scrollback, and appended once it is shown.
+    def AppendTerminal(self, text):
+        if not text:
+            return
+        if not self.IsShownOnScreen():
+            self.hidden.append(text)
+            self.hiddenLines += text.count('\n')
+            self.TrimHidden()
+            return
+
+        # text of the hidden time first, in one go
+        if self.hidden:
+            text = ''.join(self.hidden) + text
+            self.hidden = []
+            self.hiddenLines = 0
+        self.txtTerm.AppendText(text)
+        self.lineCount += text.count('\n')
+        self.TrimTerminal()
+
+    ## Append the text kept while the panel was hidden
+    def FlushTerminal(self):
+        if self.hidden:
+            text = ''.join(self.hidden)
+            self.hidden = []
+            self.hiddenLines = 0
+            self.txtTerm.AppendText(text)
+            self.lineCount += text.count('\n')
+            self.TrimTerminal()
+
+    ## Drop the oldest lines of the hidden text over the scrollback, in
+    # blocks like TrimTerminal()
+    def TrimHidden(self):
+        if not self.scrollback:
+            return
+        excess = self.hiddenLines - self.scrollback
+        if excess <= 0 or excess < self.scrollback // 10:
+            return
+
+        text = ''.join(self.hidden)
+        pos = -1
+        for count in range(excess):
+            pos = text.index('\n', pos + 1)
+        self.hidden = [text[pos + 1:]]
+        self.hiddenLines -= excess
+
+    ## Remove the oldest lines over the scrollback. Unless forced, it waits
+    # until the excess is 10% of the scrollback, so the text is removed in
+    # large blocks rather than line by line.
+    def TrimTerminal(self, force=False):
+        if not self.scrollback:
+            return
+        excess = self.lineCount - self.scrollback
+        if excess <= 0 or (not force and excess < self.scrollback // 10):
+            return
+
+        pos = self.txtTerm.XYToPosition(0, excess)
+        if pos > 0:
+            self.txtTerm.Remove(0, pos)
+            self.lineCount -= excess
 
     ## Put your checksum algorithm here
     def ComputeChecksum(self, data):
@@ -261,53 +835,51 @@ class TermPanel(wx.Panel):
 
     ## Reset raw data. Terminal will be cleared as well.
     def ResetData(self):
-        self.rawdata = bytearray()
+        self.capture.Reset()
         self.ClearTerminal()
 
+    ## Replace the capture writer, e.g. with one with rotation or
+    # compression. The data of the old one is kept.
+    def SetCapture(self, capture):
+        self.thread.SetCapture(capture.Write)
+        self.capture.Stop(True)
+        self.capture = capture
+        self.capture.Start()
+
     ## Open COM port
     def OpenPort(self, port, speed):
-
-        if self.ser.is_open:
-            # terminate thread first
-            if self.thread.IsRunning():
-                self.thread.Stop()
-            # join the thread
-            while self.thread.IsRunning():
-                wx.MilliSleep(100)
-            # then close the port
-            self.ser.close()
-
-        # set port number and speed
-        self.ser.port = port
-        self.ser.baudrate = int(speed)
-        # setting read timeout is crucial for the safe termination of thread
-        self.ser.timeout = 1
-
-        # open the serial port
-        try:
-            self.ser.open()
-        except:
-            return False
-        else:
-            pass
-
-        if self.ser.is_open:
-            # start thread
-            self.thread.Start()
+        # replies to the commands sent so far will not come
+        self.cmd.Cancel()
+        # nor the data queued for the previous port is sent
+        self.writer.Clear()
+        # nor the data of the previous port is delivered
+        self.bus.Reset()
+
+        # the thread is stopped and restarted on the new port
+        if self.thread.Open(port, speed):
+            # start delivery
+            self.bus.Start()
             return True
         else:
             return False
 
-    ## Save received data
+    ## Save the data received since the last save (or reset, rotation) by
+    # renaming the capture file. Returns the file name.
     def SaveRawData(self, fname):
-        f = open(fname, 'wb')
-        f.write(self.rawdata)
-        f.close()
+        return self.capture.Save(fname)
 
-    ## Send data via COM port
+    ## Send data via COM port (queued, see ComWriter)
     def SendData(self, data):
         if self.ser.is_open:
-            self.ser.write(data)
+            self.writer.Put(data)
+
+    ## Return the statistics of the port writer
+    def GetWriterStats(self):
+        return self.writer.GetStats()
+
+    ## Set the rate (per second) of the delivery of the received data
+    def SetDeliveryRate(self, rate):
+        self.bus.SetRate(self, rate)
 
     ## Set new line character
     def SetNewLine(self, nl):
@@ -327,7 +899,7 @@ class TermPanel(wx.Panel):
             self.termType = termtype
 
         if self.termType == 'Hex':
-            self.txtTerm.AppendText('\n')
+            self.AppendTerminal('\n')
             self.binCounter = 0
 
     ## Show/hide controls
@@ -337,7 +909,24 @@ class TermPanel(wx.Panel):
 
     ## Save file button handler
     def OnFileSave(self, evt):
-        self.SaveRawData(data_file)
+        # each save holds the data since the last one: do not overwrite
+        root, ext = os.path.splitext(os.path.join(self.dataDir, data_file))
+        root += time.strftime('-%Y%m%d-%H%M%S')
+        name = root + ext
+        count = 1
+        while os.path.exists(name):
+            name = '{}-{:d}{}'.format(root, count, ext)
+            count += 1
+
+        name = self.SaveRawData(name)
+        if name:
+            wx.MessageBox('Saved to ' + name)
+
+    ## Panel show handler: the hidden text goes to the terminal
+    def OnShow(self, evt):
+        if evt.IsShown():
+            wx.CallAfter(self.FlushTerminal)
+        evt.Skip()
 
     ## Clear terminal button handler
     def OnTermClear(self, evt):
@@ -387,90 +976,85 @@ class TermPanel(wx.Panel):
         if self.rxOnly:
             return
 
-        if self.ser.is_open:
-            # key code can be multiple bytes
-            try:
-                self.ser.write([evt.GetKeyCode()])
-            except:
-                pass
+        # key code can be multiple bytes
+        if evt.GetKeyCode() < 0x100:
+            self.SendData(bytes((evt.GetKeyCode(),)))
 
         if self.localEcho:
             if self.termType == 'ASCII':
-                self.txtTerm.AppendText(chr(evt.GetKeyCode()))
+                self.AppendTerminal(chr(evt.GetKeyCode()))
             else:
-                self.txtTerm.AppendText('0x{:02X}.'.format(evt.GetKeyCode()))
+                self.AppendTerminal('0x{:02X}.'.format(evt.GetKeyCode()))
 
-    ## Local echo mode selection handler
+    ## Send a command packet. Returns a Future resolved by the reply (see
+    # CommandChannel); the callback is called on a worker thread.
+    def SendCommand(self, packet, callback=None):
+        return self.cmd.Send(packet, callback)
+
+    ## Send the selected packets as commands waiting for the ACK/NAK reply
+    # (True), or just write them (False) for the devices not replying
+    def SetAcknowledged(self, flag):
+        self.acked = flag
+
+    ## Packet selection handler
     def OnSendPacket(self, evt):
         if self.ser.is_open:
-            self.ser.write(OutPackets[self.choSndPkt.GetStringSelection()])
+            name = self.choSndPkt.GetStringSelection()
+            if self.acked:
+                self.SendCommand(OutPackets[name],
+                        lambda future: self.OnCommandDone(name, future))
+            else:
+                self.SendData(OutPackets[name])
+
+    ## Command completion callback (worker thread)
+    def OnCommandDone(self, name, future):
+        error = future.exception()
+        # NAK or timeout; cancelled ones are not reported
+        if error is not None and error.args[0] != 'cancelled':
+            wx.CallAfter(self.AppendTerminal, '\n{} failed: {}\n'.format(
+                name, error))
 
 
     ## COM data input handler
     def OnUpdateComData(self, evt):
 
-        for byte in evt.data:
-            # append incoming byte to the rawdata
-            self.rawdata.append(byte)
-
-            if self.termType == 'Protocol':
-                # pass byte to the packet decoder
-                ret = self.pd.AddByte(byte)
-                # display packet decode result
-                if ret is None:
-                    pass
-                else:
-                    self.txtTerm.AppendText(ret + '\n')
+        # one string per chunk
+        if self.termType == 'Protocol':
+            # packets decoded by the bus
+            text = ''.join([DecodeText(ret) + '\n' for ret in evt.frames])
 
-            elif self.termType == 'Hex':
-                # display formatted hex
-                self.txtTerm.AppendText('0x{:02X}'.format(byte))
-                # counter for alignment of the hex display
-                self.binCounter = self.binCounter + 1
+        elif self.termType == 'Hex':
+            text, self.binCounter = HexText(evt.data, self.binCounter)
 
-                if self.binCounter == 8:
-                    self.txtTerm.AppendText(' - ')
-
-                elif self.binCounter == 16:
-                    self.txtTerm.AppendText('\n')
-                    self.binCounter = 0
-
-                else:
-                    self.txtTerm.AppendText('.')
+        else:
+            text = AsciiText(evt.data, self.newLine)
 
-            else:
-                if self.newLine == 0x0A:
-                    if byte == 0x0D:
-                        pass
-                    elif byte == 0x0A:
-                        self.txtTerm.AppendText('\n')
-                    else:
-                        self.txtTerm.AppendText(chr(byte))
-                elif self.newLine == 0x0D:
-                    if byte == 0x0A:
-                        pass
-                    elif byte == 0x0D:
-                        self.txtTerm.AppendText('\n')
-                    else:
-                        self.txtTerm.AppendText(chr(byte))
+        self.AppendTerminal(text)
 
 
     ## wx.EVT_CLOSE handler
     def OnClose(self, evt):
-        # terminate the thread
-        if self.thread.IsRunning():
-            self.thread.Stop()
+        self.Shutdown()
+        # destroy self
+        self.Destroy()
 
-        # join the thread
-        while self.thread.IsRunning():
-            wx.MilliSleep(100)
+    ## Stop the threads and close the port and the capture. The panel gets
+    # no EVT_CLOSE when its frame is closed: call it from the frame.
+    def Shutdown(self):
+        # stop delivery
+        self.bus.Stop()
 
-        # close the port
-        if self.ser.is_open:
-            self.ser.close()
+        # fail the outstanding commands
+        self.cmd.Stop()
 
-        # destroy self
-        self.Destroy()
+        # stop writing
+        self.writer.Stop()
+
+        # terminate the thread and close the port
+        self.thread.Close()
+
+        # unsaved data is discarded (kept if rotating)
+        self.capture.Stop()
 
 
 #--------1---------2---------3---------4---------5---------6---------7---------8
@@ -478,11 +1062,12 @@ if __name__=="__main__":
 
     class MyFrame(wx.Frame):
 
-        def __init__(self, parent, title):
+        def __init__(self, parent, title, ports=None):
             wx.Frame.__init__(self, parent, title=title)
 
             # serial terminal panel
-            self.pnlTerm = TermPanel(self, serial.Serial(), size=(900,400))
+            self.pnlTerm = TermPanel(self, serial.Serial(), ports,
+                    size=(900,400))
 
             # sizer
             self.sizer = wx.BoxSizer(wx.VERTICAL)
@@ -491,9 +1076,53 @@ if __name__=="__main__":
             self.SetSizer(self.sizer)
             self.SetAutoLayout(1)
             self.sizer.Fit(self)
+            self.Bind(wx.EVT_CLOSE, self.OnClose)
             self.Show()
-    
+
+        def OnClose(self, evt):
+            self.pnlTerm.Shutdown()
+            self.Destroy()
+
+    import sys
+
+    # unit test of the chunk read: python3 wxTerm.py --test
+    if sys.argv[1:] == ['--test']:
+        print('Unit Test for ComThread.ReadChunk()')
+
+        # port with the bytes always waiting, which come slowly
+        class FakeSerial:
+            timeout = 1
+            def __init__(self, waiting, delay):
+                self.in_waiting = waiting
+                self.delay = delay
+                self.sizes = []
+            def read(self, size=1):
+                self.sizes.append(size)
+                time.sleep(self.delay)
+                return bytes(size)
+
+        # limited by the size, or by the time
+        for maxChunk, maxLatency, waiting, delay in (
+                (4096, 0.01, 1 << 16, 0.0), (100, 1, 1 << 16, 0.0),
+                (1 << 20, 0.02, 1 << 16, 0.0005), (4096, 0.01, 64, 0.001),
+                (1 << 20, 0.005, 1, 0.0)):
+            ser = FakeSerial(waiting, delay)
+            thread = ComThread(None, ser, maxChunk, maxLatency)
+            start = time.monotonic()
+            chunk = thread.ReadChunk()
+            elapsed = time.monotonic() - start
+            # never more than the maximum size, nor longer than the latency
+            # (and a read) after the first byte
+            ok = len(chunk) <= maxChunk and max(ser.sizes) <= maxChunk and \
+                    elapsed <= maxLatency + 2 * delay + 0.005
+            print('{:8d} bytes in {:5.1f} ms ({:d} reads, max {:.0f} ms): {}'
+                    .format(len(chunk), elapsed * 1e3, len(ser.sizes),
+                    maxLatency * 1e3, 'OK' if ok else 'FAIL'))
+            assert ok
+        sys.exit(0)
+
     # app loop
     app = wx.App()
-    frame = MyFrame(None, "Serial Terminal Demo")
+    # extra ports (TSCSim.py for example) from the command line
+    frame = MyFrame(None, "Serial Terminal Demo", sys.argv[1:])
     app.MainLoop()